@@ -0,0 +1,376 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class PGD(object):
+    """Projected gradient ascent: only the final delta is used by the caller.
+
+    With grad_mode='full' every step backpropagates the adversarial loss into the model, moves
+    delta and clears the model gradients again. With grad_mode='delta' the gradient is taken with
+    respect to delta only, so the weight gradients are never computed and the parameter .grad
+    buffers are left untouched."""
+    def run(self, engine, embed_fn, loss_fn, attention_mask, slot, backward, zero_grad, rows=None):
+        embeds = embed_fn()
+        delta = engine.init_delta(embeds, attention_mask, slot, rows)
+        for step in range(engine.adv_steps):
+            loss = loss_fn(embeds + delta)
+            if engine.grad_mode == 'delta':
+                # the embedding lookup is not on the path to delta, so its graph survives
+                delta_grad, = torch.autograd.grad(loss, delta, only_inputs=True, retain_graph=False)
+                engine.ascend_(delta, delta_grad)
+                continue
+            backward(loss)
+            engine.ascend_(delta, delta.grad)
+            delta.grad = None
+            # the backward pass freed the graph of the embedding lookup
+            embeds = embed_fn()
+            if zero_grad is not None:
+                zero_grad()
+        return embeds, delta.detach(), loss.detach()
+
+class FreeLB(object):
+    """FreeLB: the model gradients of the adv_steps ascent steps are accumulated (each loss scaled
+    by 1/adv_steps) and delta is not moved after the last step."""
+    def run(self, engine, embed_fn, loss_fn, attention_mask, slot, backward, zero_grad, rows=None):
+        embeds = embed_fn()
+        delta = engine.init_delta(embeds, attention_mask, slot, rows)
+        total_loss = 0
+        for astep in range(engine.adv_steps):
+            loss = loss_fn(embeds + delta) / engine.adv_steps
+            backward(loss)
+            total_loss = total_loss + loss.detach()
+            if astep == engine.adv_steps - 1:
+                break
+            engine.ascend_(delta, delta.grad)
+            delta.grad = None
+            embeds = embed_fn()
+        delta.grad = None
+        return embeds, delta.detach(), total_loss
+
+class VAT(object):
+    """Virtual adversarial (SMART) ascent: delta starts from Gaussian noise and follows the gradient
+    of a divergence to the clean predictions, taken with respect to delta only.
+
+    update='project' normalizes the gradient per example and projects delta like PGD,
+    update='token' renormalizes every token of (delta + adv_lr * grad) as in the SMART code."""
+    def __init__(self, update='project'):
+        self.update = update
+
+    def run(self, engine, embed_fn, loss_fn, attention_mask, slot, backward, zero_grad, rows=None):
+        embeds = embed_fn()
+        delta = engine.init_noise(embeds, slot)
+        loss = None
+        for step in range(engine.adv_steps):
+            loss = loss_fn(embeds + delta)
+            delta_grad, = torch.autograd.grad(loss, delta, only_inputs=True, retain_graph=False)
+            if self.update == 'token':
+                engine.token_ascend_(delta, delta_grad)
+            else:
+                engine.ascend_(delta, delta_grad)
+        return embeds, delta.detach(), None if loss is None else loss.detach()
+
+STRATEGIES = {
+    'pgd': PGD,
+    'freelb': FreeLB,
+    'vat': VAT,
+    'smart': lambda: VAT(update='token'),
+}
+
+class PerturbationBank(object):
+    """Memory-mapped store of the last perturbation of every dataset row, so that the next epoch's
+    adversary warm-starts from it instead of from noise.
+
+    A delta is compressed to its `tokens` largest-norm token vectors (top-token sparsification),
+    kept as fp16 with a per-row fp32 scale. Rows are mapped to `slots` fixed slots and the least
+    recently stored row is evicted when the bank is full.
+
+    save() writes the row -> slot index next to the arrays, together with `meta`, a JSON-able
+    description of what the rows are (data, domain pair, row offsets, hidden size). With reuse, a
+    bank opened on a directory holding a saved store with the same meta, tokens and slots reopens
+    it and warm-starts from it, e.g. to resume an interrupted run. Otherwise the arrays are
+    created anew on the first store, once the hidden size is known. Rows stored after the last
+    save() are not in the index of a later run.
+    """
+    def __init__(self, path, tokens=16, slots=65536, meta=None, reuse=False):
+        self.path = path
+        self.tokens = tokens
+        self.slots = slots
+        self.meta = meta or {}
+        self.values = None
+        self.slot_of = OrderedDict()  # dataset row -> slot, least recently stored first
+        self.free = list(range(slots - 1, -1, -1))
+        if reuse:
+            self._open()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _identity(self, hidden_size):
+        identity = dict(self.meta, tokens=self.tokens, slots=self.slots)
+        identity.setdefault('hidden_size', hidden_size)
+        # as it reads back from meta.json, tuples become lists
+        return json.loads(json.dumps(identity))
+
+    def _open(self):
+        names = ('values.npy', 'positions.npy', 'scales.npy', 'index.npy', 'meta.json')
+        if not all(os.path.exists(self._file(name)) for name in names):
+            return
+        values = np.load(self._file('values.npy'), mmap_mode='r+')
+        with open(self._file('meta.json')) as f:
+            stored = json.load(f)
+        identity = self._identity(values.shape[-1])
+        if stored != identity or values.shape != (self.slots, self.tokens, identity['hidden_size']):
+            return
+        self.values = values
+        self.positions = np.load(self._file('positions.npy'), mmap_mode='r+')
+        self.scales = np.load(self._file('scales.npy'), mmap_mode='r+')
+        index = np.load(self._file('index.npy'))
+        self.slot_of = OrderedDict((int(row), int(slot)) for row, slot in index)
+        used = set(self.slot_of.values())
+        self.free = [slot for slot in range(self.slots - 1, -1, -1) if slot not in used]
+
+    def _allocate(self, hidden_size):
+        os.makedirs(self.path, exist_ok=True)
+        # the index and meta of an old store no longer describe the arrays
+        for name in ('index.npy', 'meta.json'):
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+        self.values = np.lib.format.open_memmap(self._file('values.npy'), mode='w+',
+                                                dtype=np.float16, shape=(self.slots, self.tokens, hidden_size))
+        self.positions = np.lib.format.open_memmap(self._file('positions.npy'), mode='w+',
+                                                   dtype=np.int32, shape=(self.slots, self.tokens))
+        self.scales = np.lib.format.open_memmap(self._file('scales.npy'), mode='w+',
+                                                dtype=np.float32, shape=(self.slots,))
+        self.slot_of = OrderedDict()
+        self.free = list(range(self.slots - 1, -1, -1))
+
+    def save(self):
+        """Flushes the arrays and writes the meta and the index, in least recently stored order."""
+        if self.values is None:
+            return
+        for array in (self.values, self.positions, self.scales):
+            array.flush()
+        tmp = self._file('meta.tmp.json')
+        with open(tmp, 'w') as f:
+            json.dump(self._identity(self.values.shape[-1]), f)
+        os.replace(tmp, self._file('meta.json'))
+        index = np.array(list(self.slot_of.items()), dtype=np.int64).reshape(-1, 2)
+        tmp = self._file('index.tmp.npy')
+        np.save(tmp, index)
+        os.replace(tmp, self._file('index.npy'))
+
+    def _slot(self, row):
+        if row in self.slot_of:
+            self.slot_of.move_to_end(row)
+            return self.slot_of[row]
+        slot = self.free.pop() if self.free else self.slot_of.popitem(last=False)[1]
+        self.slot_of[row] = slot
+        return slot
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    @torch.no_grad()
+    def store(self, rows, delta):
+        if self.values is None or self.values.shape[-1] != delta.shape[-1]:
+            self._allocate(delta.shape[-1])
+        k = min(self.tokens, delta.shape[1])
+        positions = delta.float().norm(dim=-1).topk(k, dim=1).indices
+        values = delta.gather(1, positions.unsqueeze(-1).expand(-1, -1, delta.shape[-1])).float()
+        # fp16 on its own would flush the typical 1e-5 sized perturbations to zero
+        scales = values.abs().amax(dim=(1, 2)).clamp_(min=1e-30)
+        values = (values / scales.view(-1, 1, 1)).half()
+
+        slots = np.array([self._slot(row) for row in rows.tolist()], dtype=np.int64)
+        self.values[slots, :k] = values.cpu().numpy()
+        self.positions[slots] = -1
+        self.positions[slots, :k] = positions.cpu().numpy()
+        self.scales[slots] = scales.cpu().numpy()
+
+    @torch.no_grad()
+    def warm_start_(self, delta, rows):
+        """Overwrites the rows of delta that have a stored perturbation, returns how many did."""
+        hits = [(i, self.slot_of[row]) for i, row in enumerate(rows.tolist()) if row in self.slot_of]
+        if not hits:
+            return 0
+        batch_rows, slots = (np.array(column, dtype=np.int64) for column in zip(*hits))
+        width = delta.shape[1]
+        positions = torch.from_numpy(self.positions[slots]).to(delta.device).long()
+        values = torch.from_numpy(np.asarray(self.values[slots])).to(delta.device, delta.dtype)
+        values = values * torch.from_numpy(self.scales[slots]).to(delta).view(-1, 1, 1)
+        # unused entries and tokens beyond this batch's width land in a spare column
+        positions = positions.masked_fill((positions < 0) | (positions >= width), width)
+        warm = delta.new_zeros(len(slots), width + 1, delta.shape[-1])
+        warm.scatter_(1, positions.unsqueeze(-1).expand_as(values), values)
+        delta[torch.from_numpy(batch_rows).to(delta.device)] = warm[:, :width]
+        return len(slots)
+
+class PerturbationEngine(object):
+    """Word-embedding perturbations shared by the adversarial trainers.
+
+    The delta tensors live in preallocated buffers, one per (slot, batch shape), that are refilled
+    in place for every batch, and the normalize-and-project step of the ascent is done in place on
+    the whole batch. The ascent strategy is pluggable (see STRATEGIES) and the wall time spent in
+    it is accumulated for reporting, on CUDA through events that are only resolved by summary().
+    norm_type 'l1' (sign of the gradient) only exists for the token-level SMART update.
+    """
+    def __init__(self, strategy='pgd', norm_type='linf', adv_steps=1, adv_lr=1e-4, adv_max_norm=0,
+                 adv_init_mag=0, adv_noise_var=0, grad_mode='full', bank=None, max_buffers=8):
+        if norm_type not in ('l2', 'linf', 'l1'):
+            raise ValueError("Norm type {} not specified.".format(norm_type))
+        self.strategy = STRATEGIES[strategy]() if isinstance(strategy, str) else strategy
+        if norm_type == 'l1' and getattr(self.strategy, 'update', None) != 'token':
+            raise ValueError("Norm type l1 is only supported by the token-level (smart) ascent, not by {}.".format(
+                type(self.strategy).__name__))
+        self.norm_type = norm_type
+        self.adv_steps = adv_steps
+        self.adv_lr = adv_lr
+        self.adv_max_norm = adv_max_norm
+        self.adv_init_mag = adv_init_mag
+        self.adv_noise_var = adv_noise_var
+        self.grad_mode = grad_mode
+        self.bank = bank
+        self.max_buffers = max_buffers
+        self.buffers = OrderedDict()
+        self.reset_timings()
+
+    @classmethod
+    def from_args(cls, args, strategy='pgd', bank_meta=None, bank_reuse=False, **overrides):
+        """bank_meta describes the rows of the bank (see PerturbationBank), a saved bank is reused
+        with bank_reuse or --adv_bank_reuse."""
+        kwargs = dict(
+            norm_type=args.norm_type,
+            adv_steps=args.adv_steps,
+            adv_lr=args.adv_lr,
+            adv_max_norm=args.adv_max_norm,
+            adv_init_mag=getattr(args, 'adv_init_mag', 0),
+            adv_noise_var=getattr(args, 'adv_noise_var', 0),
+            grad_mode=getattr(args, 'adv_grad_mode', 'full'),
+        )
+        if getattr(args, 'adv_bank_dir', ''):
+            kwargs['bank'] = PerturbationBank(os.path.join(args.adv_bank_dir, strategy), tokens=args.adv_bank_tokens,
+                                              slots=args.adv_bank_slots, meta=bank_meta,
+                                              reuse=bank_reuse or getattr(args, 'adv_bank_reuse', False))
+        kwargs.update(overrides)
+        return cls(strategy, **kwargs)
+
+    def buffer(self, like, slot='delta'):
+        key = (slot, tuple(like.shape), like.dtype, like.device)
+        if key in self.buffers:
+            self.buffers.move_to_end(key)
+        else:
+            self.buffers[key] = torch.zeros(like.shape, dtype=like.dtype, device=like.device)
+            if len(self.buffers) > self.max_buffers:
+                self.buffers.popitem(last=False)
+        delta = self.buffers[key]
+        delta.grad = None
+        return delta
+
+    @torch.no_grad()
+    def init_delta(self, embeds, attention_mask, slot='delta', rows=None):
+        """Random start inside the adv_init_mag ball (or adv_noise_var Gaussian noise) on the real
+        tokens, or the banked perturbation of the dataset rows that have one."""
+        delta = self.buffer(embeds, slot)
+        if self.adv_init_mag > 0:
+            input_mask = attention_mask.to(embeds).unsqueeze(2)
+            if self.norm_type == "l2":
+                dims = input_mask.sum(1, keepdim=True) * embeds.size(-1)
+                delta.uniform_(-1, 1).mul_(input_mask).mul_(self.adv_init_mag / torch.sqrt(dims))
+            elif self.norm_type == "linf":
+                delta.uniform_(-self.adv_init_mag, self.adv_init_mag).mul_(input_mask)
+            else:
+                delta.zero_()
+        elif self.adv_noise_var > 0:
+            delta.normal_(0, 1).mul_(self.adv_noise_var).mul_(attention_mask.to(embeds).unsqueeze(2))
+        else:
+            delta.zero_()
+        if self.bank is not None and rows is not None:
+            self.bank.warm_start_(delta, rows)
+        return delta.requires_grad_()
+
+    @torch.no_grad()
+    def init_noise(self, embeds, slot='delta'):
+        delta = self.buffer(embeds, slot)
+        delta.normal_(0, 1).mul_(self.adv_noise_var)
+        return delta.requires_grad_()
+
+    @torch.no_grad()
+    def ascend_(self, delta, grad):
+        """delta += adv_lr * grad / ||grad|| per example, then projected back into the adv_max_norm ball."""
+        flat_grad = grad.reshape(grad.size(0), -1)
+        if self.norm_type == "l2":
+            denorm = flat_grad.norm(p=2, dim=1)
+        else:
+            denorm = flat_grad.abs().amax(dim=1)
+        delta.addcdiv_(grad, denorm.clamp_(min=1e-8).view(-1, 1, 1), value=self.adv_lr)
+        if self.adv_max_norm > 0:
+            if self.norm_type == "l2":
+                delta_norm = delta.reshape(delta.size(0), -1).float().norm(p=2, dim=1)
+                delta.mul_((self.adv_max_norm / delta_norm).clamp_(max=1).view(-1, 1, 1).to(delta))
+            else:
+                delta.clamp_(-self.adv_max_norm, self.adv_max_norm)
+
+    @torch.no_grad()
+    def token_ascend_(self, delta, grad):
+        delta.add_(grad, alpha=self.adv_lr)
+        if self.norm_type == 'l2':
+            delta.div_(delta.norm(dim=-1, keepdim=True) + self.adv_max_norm)
+        elif self.norm_type == 'l1':
+            delta.sign_()
+        else:
+            delta.div_(delta.abs().amax(-1, keepdim=True) + self.adv_max_norm)
+
+    def perturb(self, embed_fn, loss_fn, attention_mask, slot='delta', backward=None, zero_grad=None, rows=None):
+        """Runs the ascent strategy.
+
+        embed_fn() returns the clean input embeddings (called again whenever a backward pass has
+        freed their graph), loss_fn(inputs_embeds) the adversarial loss. rows are the dataset
+        indices of the batch, used to warm-start from and update the perturbation bank. Returns
+        the clean embeddings, the final (detached) delta and the ascent loss.
+        """
+        start = self._clock(attention_mask.device)
+        out = self.strategy.run(self, embed_fn, loss_fn, attention_mask, slot,
+                                backward or (lambda loss: loss.backward()), zero_grad, rows)
+        if self.bank is not None and rows is not None:
+            self.bank.store(rows, out[1])
+        end = self._clock(attention_mask.device)
+        if attention_mask.is_cuda:
+            # kernels are asynchronous, the host clock would only time their launch
+            self.pending_timings.append((start, end))
+        else:
+            self.ascent_time += end - start
+        self.ascent_calls += 1
+        return out
+
+    @staticmethod
+    def _clock(device):
+        if device.type == 'cuda':
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def save_bank(self):
+        if self.bank is not None:
+            self.bank.save()
+
+    def reset_timings(self):
+        self.ascent_time = 0.0
+        self.ascent_calls = 0
+        self.pending_timings = []
+
+    def resolve_timings(self):
+        if self.pending_timings:
+            self.pending_timings[-1][1].synchronize()
+            self.ascent_time += sum(start.elapsed_time(end) for start, end in self.pending_timings) / 1000
+            self.pending_timings = []
+
+    def summary(self):
+        self.resolve_timings()
+        per_call = 1000 * self.ascent_time / max(self.ascent_calls, 1)
+        return "adversarial ascent: {} calls, {:.1f}s, {:.1f} ms/call".format(self.ascent_calls, self.ascent_time, per_call)
@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import queue
+import random
+import struct
+import threading
+
+import numpy as np
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+
+def snapshot(obj):
+    """Host-memory copy of a (nested) state dict, taken on the training thread so that training can
+    go on updating the parameters while the copy is written."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+def rng_states():
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if states['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+def atomic_save(obj, path):
+    tmp = path + '.tmp'
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+# ---compact model checkpoints---
+# A model checkpoint is either a torch.save'd fp32 state dict ('full') or a safetensors file, which
+# load_model_state memory-maps and reads tensor by tensor:
+#   'fp16'  floating point tensors in half precision
+#   'delta' weights that come from the pretrained BERT as an int8 delta against it with one fp32
+#           scale per row, unchanged ones not at all, everything else (the heads) in fp32
+CKPT_FORMATS = ('full', 'fp16', 'delta')
+
+_pretrained_states = {}
+
+def pretrained_state(name="bert-base-uncased"):
+    """State dict of the pretrained BERT the 'delta' format is relative to, loaded once per process."""
+    if name not in _pretrained_states:
+        from model import pretrained_bert
+        _pretrained_states[name] = {key: value.detach().float() for key, value in pretrained_bert(name).state_dict().items()}
+    return _pretrained_states[name]
+
+def base_key(key, base):
+    """'bert.encoder.layer.0...' (or 'bert2.'...) -> the pretrained key it started from, None for the heads."""
+    prefix, _, rest = key.partition('.')
+    return rest if prefix.startswith('bert') and rest in base else None
+
+def quantize_rows(delta):
+    # one scale per row of a matrix, a vector (bias, LayerNorm) is a single row with one scale
+    rows = delta.reshape(delta.shape[0], -1) if delta.dim() > 1 else delta.reshape(1, -1)
+    scale = rows.abs().amax(dim=1) / 127
+    q = torch.round(rows / scale.clamp(min=torch.finfo(torch.float32).tiny).unsqueeze(1)).to(torch.int8)
+    return q.reshape(delta.shape), scale
+
+def save_compact(state_dict, path, ckpt_format='fp16', base_name="bert-base-uncased"):
+    base = pretrained_state(base_name) if ckpt_format == 'delta' else None
+    tensors = {}
+    layout = {}
+    for key, value in state_dict.items():
+        value = value.detach().cpu()
+        if not value.is_floating_point():
+            tensors[key] = value.clone()
+            layout[key] = ['raw']
+        elif ckpt_format == 'fp16':
+            tensors[key] = value.half()
+            layout[key] = ['fp16', str(value.dtype)]
+        elif base_key(key, base) is not None and base[base_key(key, base)].shape == value.shape:
+            delta = value.float() - base[base_key(key, base)]
+            if not delta.any():
+                layout[key] = ['base', base_key(key, base)]
+                continue
+            tensors[key], tensors[key + '.__scale__'] = quantize_rows(delta)
+            layout[key] = ['delta', base_key(key, base)]
+        else:
+            tensors[key] = value.float().contiguous()
+            layout[key] = ['raw']
+    tmp = path + '.tmp'
+    save_file(tensors, tmp, metadata={'format': ckpt_format, 'base': base_name, 'layout': json.dumps(layout)})
+    os.replace(tmp, path)
+
+def save_model_state(state_dict, path, ckpt_format='full'):
+    if ckpt_format == 'full':
+        atomic_save(state_dict, path)
+    else:
+        save_compact(state_dict, path, ckpt_format)
+
+
+class CompactCheckpoint(object):
+    """Lazy view of a save_compact file: the file is memory-mapped and a tensor is only read (and
+    for 'delta' added to the pretrained weight) when it is asked for, so e.g. an analysis that only
+    needs the heads never touches the BERT weights. The pretrained base is only loaded for the
+    first 'delta' or 'base' tensor."""
+    def __init__(self, path, base=None):
+        self.file = safe_open(path, framework='pt', device='cpu')
+        metadata = self.file.metadata()
+        self.format = metadata['format']
+        self.layout = json.loads(metadata['layout'])
+        self.base_name = metadata['base']
+        self._base = base
+
+    @property
+    def base(self):
+        if self._base is None:
+            self._base = pretrained_state(self.base_name)
+        return self._base
+
+    def keys(self):
+        return self.layout.keys()
+
+    def __getitem__(self, key):
+        entry = self.layout[key]
+        if entry[0] == 'raw':
+            return self.file.get_tensor(key)
+        if entry[0] == 'fp16':
+            return self.file.get_tensor(key).to(getattr(torch, entry[1].replace('torch.', '')))
+        if entry[0] == 'base':
+            return self.base[entry[1]].clone()
+        q = self.file.get_tensor(key)
+        scale = self.file.get_tensor(key + '.__scale__')
+        delta = q.reshape(scale.shape[0], -1).float() * scale.unsqueeze(1)
+        return self.base[entry[1]] + delta.reshape(q.shape)
+
+    def state_dict(self, keys=None):
+        return {key: self[key] for key in (keys if keys is not None else self.keys())}
+
+def is_safetensors(path):
+    """Whether path is a safetensors file: a little-endian u64 header length followed by that many
+    bytes of JSON header. Anything else is taken for a torch.save file, zip or legacy."""
+    with open(path, 'rb') as f:
+        prefix = f.read(8)
+        if len(prefix) < 8:
+            return False
+        size = struct.unpack('<Q', prefix)[0]
+        if size > os.path.getsize(path) - 8:
+            return False
+        try:
+            return isinstance(json.loads(f.read(size)), dict)
+        except ValueError:
+            return False
+
+def load_model_state(path, keys=None, map_location='cpu'):
+    """A model state dict from a checkpoint in any of CKPT_FORMATS, only `keys` if given. Any
+    other torch.save file (e.g. the feature tensors tsne.py and svm.py read) is loaded as is."""
+    if not is_safetensors(path):
+        state = torch.load(path, map_location=map_location)
+        return state if keys is None else {key: state[key] for key in keys}
+    state = CompactCheckpoint(path).state_dict(keys)
+    return {key: value.to(map_location) for key, value in state.items()}
+
+
+class AsyncCheckpointer(object):
+    """Writes checkpoints on a background thread.
+
+    Every save snapshots its state to host memory on the calling thread and queues the write, a
+    file only appears under its final name once it is complete (write to .tmp, then rename).
+    save_state keeps the one latest full training state (state.pt in directory) for resuming,
+    save_best keeps the keep_best best model checkpoints by score and deletes the ones that drop
+    out, in ckpt_format (see CKPT_FORMATS). The (score, path) list of the kept checkpoints is `best`, which belongs in the training
+    state, and best_path() is the file of the best one. A score equal to a kept one counts as
+    better, the >= rule the trainers always used: of equal scores the newer checkpoint is kept,
+    which with keep_best > 1 deliberately deletes the older equal one. At most max_pending writes
+    wait in the queue, a further save blocks until the writer catches up.
+    """
+    def __init__(self, directory, keep_best=1, max_pending=1, ckpt_format='full'):
+        self.directory = directory
+        self.keep_best = keep_best
+        self.ckpt_format = ckpt_format
+        os.makedirs(directory, exist_ok=True)
+        self.best = []
+        self.error = None
+        self.jobs = queue.Queue(maxsize=max(max_pending, 1))
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    @property
+    def state_path(self):
+        return os.path.join(self.directory, 'state.pt')
+
+    def _write_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            try:
+                job()
+            except Exception as e:
+                self.error = e
+            self.jobs.task_done()
+
+    def _submit(self, job):
+        if self.error is not None:
+            raise self.error
+        self.jobs.put(job)
+
+    def save_state(self, state):
+        state = snapshot(state)
+        self._submit(lambda: atomic_save(state, self.state_path))
+
+    def load_state(self, map_location='cpu'):
+        if not os.path.exists(self.state_path):
+            return None
+        # the state holds the python and numpy RNG states next to the tensors
+        return torch.load(self.state_path, map_location=map_location, weights_only=False)
+
+    def clear_state(self):
+        self.wait()
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def is_best(self, score):
+        return len(self.best) < self.keep_best or score >= min(s for s, p in self.best)
+
+    def save_best(self, state_dict, score, path):
+        """Saves state_dict to path if score is among the keep_best best so far, returns whether it did."""
+        if not self.is_best(score):
+            return False
+        # the sort is stable, so of equal scores the newer checkpoint stays in front and is kept
+        self.best.insert(0, (score, path))
+        self.best.sort(key=lambda entry: -entry[0])
+        dropped = [p for s, p in self.best[self.keep_best:] if p != path]
+        self.best = self.best[:self.keep_best]
+        state_dict = snapshot(state_dict)
+
+        def write():
+            save_model_state(state_dict, path, self.ckpt_format)
+            for p in dropped:
+                if os.path.exists(p):
+                    os.remove(p)
+        self._submit(write)
+        return True
+
+    def best_path(self):
+        return self.best[0][1] if self.best else None
+
+    def wait(self):
+        self.jobs.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.wait()
+        self.jobs.put(None)
+        self.thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rewrite saved model checkpoints in a compact format.')
+    parser.add_argument('paths', nargs='+',
+                        help='checkpoints to convert, in place')
+    parser.add_argument('--ckpt_format', type=str, default='delta', choices=CKPT_FORMATS,
+                        help='format to convert to')
+    args = parser.parse_args()
+    for path in args.paths:
+        before = os.path.getsize(path)
+        save_model_state(load_model_state(path), path, args.ckpt_format)
+        print(path, before, '->', os.path.getsize(path))
@@ -1,89 +1,78 @@
 import torch
+import os
+import json
+import math
+import shutil
 import random
+import hashlib
+import functools
 import numpy as np
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader, Sampler
 from transformers import AutoTokenizer
 from pathlib import Path
 
 small_domain_names = ['beauty', 'book', 'electronics', 'music']
 
-def split_small(domain_name):
-    data_dir = "data/small/" + domain_name
+def label_to_class(label):
+    if label == '5.0' or label == '4.0':
+        return 2
+    elif label == '3.0':
+        return 1
+    else:
+        return 0
+
+def split_small(domain_name, seed=None, val_sizes=(333, 333, 334), data_root="data/small"):
+    """Write the .labeled/.unlabeled/.train/.val files of a domain.
+
+    val_sizes gives the number of validation reviews of class 0, 1 and 2 (negative, neutral,
+    positive). The validation rows are drawn by row index, so duplicate texts are split
+    correctly. Memory stays at about one byte per labeled review: the label file is scanned
+    once to count the classes, then text and labels are streamed in a single pass.
+    """
+    data_dir = data_root + "/" + domain_name
     labeled_text_path = data_dir + "/set1_text.txt"
     labeled_label_path = data_dir + "/set1_label.txt"
     unlabeled_text_path = data_dir + '/set2_text.txt'
 
-    l_t_f = open(labeled_text_path, 'r')
-    l_l_f = open(labeled_label_path, 'r')
-    ul_t_f = open(unlabeled_text_path, 'r')
-
-    pos_text = []
-    neg_text = []
-    neu_text = []
-
-    for text, label in zip(l_t_f.readlines(), l_l_f.readlines()):
-        text = text.strip('\n')
-        label = label.strip('\n')
-        if label == '5.0' or label == '4.0':
-            pos_text.append(text)
-        elif label == '3.0':
-            neu_text.append(text)
-        else:
-            neg_text.append(text)
-    #pos_text = list(set(pos_text))
-    #neg_text = list(set(neg_text))
-    #neu_text = list(set(neu_text))
-    #print (len(pos_text))
-    #print (len(neg_text))
-    #print (len(neu_text))
-
-    process_labeled_path = "data/small/" + domain_name + ".labeled"
-    process_unlabeled_path = "data/small/" + domain_name + ".unlabeled"
-    process_train_path = "data/small/" + domain_name + ".train"
-    process_val_path = "data/small/" + domain_name + ".val"
-
-    labeled_f = open(process_labeled_path, 'w')
-    unlabeled_f = open(process_unlabeled_path, 'w')
-    train_f = open(process_train_path, 'w')
-    val_f = open(process_val_path, 'w')
-
-    for text in pos_text:
-        labeled_f.write('2\t' + text + '\n')
-    for text in neu_text:
-        labeled_f.write('1\t' + text + '\n')
-    for text in neg_text:
-        labeled_f.write('0\t' + text + '\n')
-
-    pos_text_sampled = np.random.choice(pos_text, 334, replace=False)
-    neu_text_sampled = np.random.choice(neu_text, 333, replace=False)
-    neg_text_sampled = np.random.choice(neg_text, 333, replace=False)
-
-
-    for text in pos_text:
-        if text in pos_text_sampled:
-            val_f.write('2\t' + text + '\n')
-        else:
-            train_f.write('2\t' + text + '\n')
-    for text in neu_text:
-        if text in neu_text_sampled:
-            val_f.write('1\t' + text + '\n')
-        else:
-            train_f.write('1\t' + text + '\n')
-    for text in neg_text:
-        if text in neg_text_sampled:
-            val_f.write('0\t' + text + '\n')
-        else:
-            train_f.write('0\t' + text + '\n')
+    rng = np.random if seed is None else np.random.default_rng(seed)
+
+    # (1) count the classes and draw the validation rows of each class
+    counts = [0, 0, 0]
+    with open(labeled_label_path, 'r') as l_l_f:
+        for label in l_l_f:
+            counts[label_to_class(label.strip('\n'))] += 1
+    is_val = []
+    for c in range(3):
+        class_is_val = np.zeros(counts[c], dtype=bool)
+        class_is_val[rng.choice(counts[c], val_sizes[c], replace=False)] = True
+        is_val.append(class_is_val)
+
+    # (2) stream the reviews into per-class parts, keeping the original positive/neutral/negative order
+    process_paths = {split: data_root + "/" + domain_name + "." + split for split in ['labeled', 'unlabeled', 'train', 'val']}
+    part_paths = {(split, c): process_paths[split] + ".part" + str(c) for split in ['labeled', 'train', 'val'] for c in range(3)}
+    part_files = {key: open(path, 'w') for key, path in part_paths.items()}
+
+    seen = [0, 0, 0]
+    with open(labeled_text_path, 'r') as l_t_f, open(labeled_label_path, 'r') as l_l_f:
+        for text, label in zip(l_t_f, l_l_f):
+            c = label_to_class(label.strip('\n'))
+            line = str(c) + '\t' + text.strip('\n') + '\n'
+            part_files[('labeled', c)].write(line)
+            part_files[('val' if is_val[c][seen[c]] else 'train', c)].write(line)
+            seen[c] += 1
+    for f in part_files.values():
+        f.close()
 
-    for text in ul_t_f.readlines():
-        unlabeled_f.write(text)
+    for split in ['labeled', 'train', 'val']:
+        with open(process_paths[split], 'w') as out_f:
+            for c in [2, 1, 0]:
+                with open(part_paths[(split, c)], 'r') as part_f:
+                    shutil.copyfileobj(part_f, out_f)
+                os.remove(part_paths[(split, c)])
 
-    l_t_f.close()
-    l_l_f.close()
-    ul_t_f.close()
-    labeled_f.close()
-    unlabeled_f.close()
-    train_f.close()
-    val_f.close()
+    with open(unlabeled_text_path, 'r') as ul_t_f, open(process_paths['unlabeled'], 'w') as unlabeled_f:
+        shutil.copyfileobj(ul_t_f, unlabeled_f)
 
     return
 
@@ -101,18 +90,214 @@ def read_data(dir, is_unlabel = False):
     #print (len(texts))
     return texts, labels
 
-def process_small_data(domain_name, max_length = 512):
-    labeled_texts, labeled_labels = read_data("data/small/" + domain_name + ".labeled")
-    unlabeled_texts, unlabeled_labels = read_data("data/small/" + domain_name + ".unlabeled", is_unlabel=True)
-    train_texts, train_labels = read_data("data/small/" + domain_name + ".train")
-    val_texts, val_labels = read_data("data/small/" + domain_name + ".val")
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(tokenizer_name='bert-base-uncased'):
+    return AutoTokenizer.from_pretrained(tokenizer_name)
+
+def file_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def cache_key(path, tokenizer_name, max_length):
+    key = '{}-{}-{}-v1'.format(file_hash(path), tokenizer_name, max_length)
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+class RaggedColumn(object):
+    """One field of a CachedEncodings, read row by row from the flat token array.
+    fill replaces the token ids by a constant (attention mask, token types) and
+    pad_to right-pads each row with zeros, like padding='max_length'.
+    """
+    def __init__(self, ids, offsets, fill=None, pad_to=None):
+        self.ids = ids
+        self.offsets = offsets
+        self.fill = fill
+        self.pad_to = pad_to
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        length = end - start
+        row = np.zeros(self.pad_to if self.pad_to else length, dtype=np.int64)
+        if self.fill is None:
+            row[:length] = self.ids[start:end]
+        else:
+            row[:length] = self.fill
+        return row
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+class CachedEncodings(dict):
+    """BatchEncoding-like view on a token cache entry.
+
+    The token ids of all rows are stored back to back in one memory-mapped int32 array,
+    row i spans ids[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, ids, offsets, pad_to=None):
+        super().__init__()
+        self.ids = ids
+        self.offsets = offsets
+        self.pad_to = pad_to
+        self['input_ids'] = RaggedColumn(ids, offsets, pad_to=pad_to)
+        self['token_type_ids'] = RaggedColumn(ids, offsets, fill=0, pad_to=pad_to)
+        self['attention_mask'] = RaggedColumn(ids, offsets, fill=1, pad_to=pad_to)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+def build_token_cache(path, cache_path, tokenizer, max_length, is_unlabel=False):
+    texts, labels = read_data(path, is_unlabel=is_unlabel)
+    encodings = tokenizer(texts, padding=False, truncation=True, max_length=max_length)
+    lengths = np.array([len(ids) for ids in encodings['input_ids']], dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    ids = np.fromiter((token for row in encodings['input_ids'] for token in row), dtype=np.int32, count=offsets[-1])
+
+    # write into a private directory first and rename it, so concurrent runs never see a partial entry
+    tmp_path = cache_path + '.tmp.' + str(os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'ids.npy'), ids)
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    np.save(os.path.join(tmp_path, 'labels.npy'), np.array(labels, dtype=np.int64))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'source': path, 'max_length': max_length, 'num_rows': len(lengths), 'num_tokens': int(offsets[-1])}, f)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def load_cached_data(path, cache_dir, tokenizer_name='bert-base-uncased', max_length=512, is_unlabel=False, dynamic_padding=False):
+    cache_path = os.path.join(cache_dir, cache_key(path, tokenizer_name, max_length))
+    if not os.path.exists(os.path.join(cache_path, 'meta.json')):
+        os.makedirs(cache_dir, exist_ok=True)
+        build_token_cache(path, cache_path, get_tokenizer(tokenizer_name), max_length, is_unlabel=is_unlabel)
+
+    ids = np.load(os.path.join(cache_path, 'ids.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(cache_path, 'offsets.npy'))
+    labels = np.load(os.path.join(cache_path, 'labels.npy'))
+    encodings = CachedEncodings(ids, offsets, pad_to=None if dynamic_padding else max_length)
+    return encodings, labels
+
+class SmallDomainData(object):
+    """Lazy handle on the processed splits of one domain.
+
+    A split (labeled, unlabeled, train, val) is read and tokenized, or loaded from the token
+    cache, only the first time it is asked for. The unlabeled file can also be consumed as a
+    stream with unlabeled_stream, without ever holding it in memory.
+    """
+    split_names = ['labeled', 'unlabeled', 'train', 'val']
+
+    def __init__(self, domain_name, max_length=512, dynamic_padding=False, cache_dir=None, tokenizer_name='bert-base-uncased', data_root="data/small"):
+        self.domain_name = domain_name
+        self.max_length = max_length
+        self.dynamic_padding = dynamic_padding
+        self.cache_dir = cache_dir
+        self.tokenizer_name = tokenizer_name
+        self.data_root = data_root
+        self._splits = {}
+        self._datasets = {}
+
+    def path(self, split):
+        return self.data_root + "/" + self.domain_name + "." + split
+
+    def split(self, split):
+        if split not in self._splits:
+            is_unlabel = split == 'unlabeled'
+            if self.cache_dir:
+                encodings, labels = load_cached_data(self.path(split), self.cache_dir, tokenizer_name=self.tokenizer_name,
+                                                     max_length=self.max_length, is_unlabel=is_unlabel,
+                                                     dynamic_padding=self.dynamic_padding)
+            else:
+                texts, labels = read_data(self.path(split), is_unlabel=is_unlabel)
+                # with dynamic padding the sequences are stored unpadded and pad_collate pads each batch
+                padding = False if self.dynamic_padding else 'max_length'
+                encodings = get_tokenizer(self.tokenizer_name)(texts, padding=padding, truncation=True, max_length=self.max_length)
+            self._splits[split] = (encodings, labels)
+        return self._splits[split]
+
+    def dataset(self, split):
+        if split not in self._datasets:
+            encodings, labels = self.split(split)
+            self._datasets[split] = ColumnDataset(encodings, None if split == 'unlabeled' else labels,
+                                                  pad_to=None if self.dynamic_padding else self.max_length)
+        return self._datasets[split]
+
+    def unlabeled_stream(self, batch_size, shuffle=True, shuffle_buffer=10000, rank=0, world_size=1):
+        return UnlabeledStream(self.path('unlabeled'), batch_size, max_length=self.max_length,
+                               dynamic_padding=self.dynamic_padding, tokenizer_name=self.tokenizer_name,
+                               shuffle=shuffle, shuffle_buffer=shuffle_buffer, rank=rank, world_size=world_size)
+
+    @property
+    def labeled(self):
+        return self.split('labeled')
+
+    @property
+    def unlabeled(self):
+        return self.split('unlabeled')[0]
+
+    @property
+    def train(self):
+        return self.split('train')
+
+    @property
+    def val(self):
+        return self.split('val')
+
+class UnlabeledStream(torch.utils.data.IterableDataset):
+    """Reads an unlabeled file in chunks of shuffle_buffer lines and yields tokenized batches.
 
-    tokenizer = AutoTokenizer.from_pretrained('bert-base-uncased')
+    Lines are shuffled inside each chunk and every pass re-reads the file. With several
+    DataLoader workers (and several processes, rank of world_size) each reader takes every
+    (num_workers * world_size)-th line.
+    """
+    def __init__(self, path, batch_size, max_length=512, dynamic_padding=False, tokenizer_name='bert-base-uncased', shuffle=True, shuffle_buffer=10000, rank=0, world_size=1):
+        super().__init__()
+        self.path = path
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.dynamic_padding = dynamic_padding
+        self.tokenizer_name = tokenizer_name
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.rank = rank
+        self.world_size = world_size
 
-    labeled_encodings = tokenizer(labeled_texts, padding='max_length', truncation=True, max_length=max_length)
-    unlabeled_encodings = tokenizer(unlabeled_texts, padding='max_length', truncation=True, max_length=max_length)
-    train_encodings = tokenizer(train_texts, padding='max_length', truncation=True, max_length=max_length)
-    val_encodings = tokenizer(val_texts, padding='max_length', truncation=True, max_length=max_length)
+    def read_chunks(self):
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers, worker_id = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id)
+        num_readers = num_workers * self.world_size
+        reader = self.rank * num_workers + worker_id
+        chunk = []
+        with open(self.path, 'r') as f:
+            for i, line in enumerate(f):
+                if i % num_readers != reader:
+                    continue
+                chunk.append(line.strip('\n'))
+                if len(chunk) == self.shuffle_buffer:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def __iter__(self):
+        tokenizer = get_tokenizer(self.tokenizer_name)
+        padding = 'longest' if self.dynamic_padding else 'max_length'
+        for chunk in self.read_chunks():
+            if self.shuffle:
+                random.shuffle(chunk)
+            for i in range(0, len(chunk), self.batch_size):
+                encodings = tokenizer(chunk[i:i + self.batch_size], padding=padding, truncation=True,
+                                      max_length=self.max_length, return_tensors='pt')
+                yield dict(encodings)
+
+def process_small_data(domain_name, max_length = 512, dynamic_padding = False, cache_dir = None, tokenizer_name = 'bert-base-uncased'):
+    data = SmallDomainData(domain_name, max_length=max_length, dynamic_padding=dynamic_padding, cache_dir=cache_dir, tokenizer_name=tokenizer_name)
+    labeled_encodings, labeled_labels = data.labeled
+    train_encodings, train_labels = data.train
+    val_encodings, val_labels = data.val
+    unlabeled_encodings = data.unlabeled
 
     return labeled_encodings, labeled_labels, train_encodings, train_labels, val_encodings, val_labels, unlabeled_encodings
 
@@ -129,6 +314,11 @@ class myDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.labels)
 
+    def lengths(self):
+        if isinstance(self.encodings, CachedEncodings):
+            return self.encodings.lengths()
+        return [len(ids) for ids in self.encodings['input_ids']]
+
 class myDataset_unlabel(torch.utils.data.Dataset):
     def __init__(self, encodings):
         self.encodings = encodings
@@ -140,6 +330,189 @@ class myDataset_unlabel(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.encodings['input_ids'])
 
+    def lengths(self):
+        if isinstance(self.encodings, CachedEncodings):
+            return self.encodings.lengths()
+        return [len(ids) for ids in self.encodings['input_ids']]
+
+class ColumnDataset(torch.utils.data.Dataset):
+    """Column-oriented replacement for myDataset / myDataset_unlabel.
+
+    All token ids live in one flat array (memory-mapped when built from a token cache) with
+    row offsets, labels in one tensor. Indexing with a list of indices gathers and pads the
+    whole batch with a single vectorized slice, so build_loader feeds it index batches from
+    a batch sampler instead of collating per-example tensors. Inputs are single segment, so
+    token_type_ids are all zero. pad_to pads every row to that width (the padding='max_length'
+    layout), None pads each batch to its longest row; a token cache carries its own.
+    """
+    def __init__(self, encodings, labels=None, pad_to=None):
+        if isinstance(encodings, CachedEncodings):
+            self.ids = encodings.ids
+            self.offsets = encodings.offsets
+            pad_to = pad_to or encodings.pad_to
+        else:
+            # drop any padding the tokenizer added, it is restored on access
+            rows = [ids[:sum(mask)] for ids, mask in zip(encodings['input_ids'], encodings['attention_mask'])]
+            lengths = np.array([len(row) for row in rows], dtype=np.int64)
+            self.offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=self.offsets[1:])
+            self.ids = np.fromiter((token for row in rows for token in row), dtype=np.int32, count=self.offsets[-1])
+        self.pad_to = pad_to
+        self.labels = None if labels is None else torch.as_tensor(np.asarray(labels), dtype=torch.long)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return {key: val[0] for key, val in self.__getitem__([idx]).items()}
+
+        idx = np.asarray(idx, dtype=np.int64)
+        starts = self.offsets[idx]
+        lengths = self.offsets[idx + 1] - starts
+        width = self.pad_to if self.pad_to else int(lengths.max())
+        positions = np.arange(width)
+        mask = positions[None, :] < lengths[:, None]
+        gather = np.where(mask, starts[:, None] + positions[None, :], 0)
+        input_ids = np.where(mask, self.ids[gather], 0)
+
+        item = {
+            'input_ids': torch.from_numpy(input_ids.astype(np.int64)),
+            'token_type_ids': torch.zeros(len(idx), width, dtype=torch.long),
+            'attention_mask': torch.from_numpy(mask.astype(np.int64)),
+        }
+        if self.labels is not None:
+            item['labels'] = self.labels[torch.from_numpy(idx)]
+        # dataset row of every example, e.g. for per-example state such as a perturbation bank
+        item['idx'] = torch.from_numpy(idx)
+        return item
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+def pad_collate(batch, pad_token_id=0):
+    # pad every field only up to the longest sequence of this batch
+    collated = {}
+    for key in batch[0]:
+        if key == 'labels':
+            collated[key] = torch.stack([item[key] for item in batch])
+        else:
+            padding_value = pad_token_id if key == 'input_ids' else 0
+            collated[key] = pad_sequence([item[key] for item in batch], batch_first=True, padding_value=padding_value)
+    return collated
+
+def shard_batches(batches, rank, world_size):
+    """Every world_size-th batch starting at rank. The list is first padded with its leading batches
+    so that all processes get the same number of batches and run the same number of steps."""
+    if world_size == 1:
+        return batches
+    batches = batches + batches[:(-len(batches)) % world_size]
+    return batches[rank::world_size]
+
+class ResumableBatchSampler(Sampler):
+    """Batch sampler whose pass is planned up front: plan() returns the batches of the next pass
+    (and advances epoch), and a pass set as next_plan = (batches, start) is replayed from batch
+    start instead, e.g. to resume a training run in the middle of a pass, see loader.InfiniteLoader."""
+    next_plan = None
+
+    def plan(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        batches, start = self.next_plan or (self.plan(), 0)
+        self.next_plan = None
+        for batch in batches[start:]:
+            yield batch
+
+class LengthBucketSampler(ResumableBatchSampler):
+    """Batch sampler that groups examples of similar length, so that pad_collate pads little.
+    When shuffling, the examples are shuffled, cut into buckets of bucket_size batches, sorted
+    by length inside each bucket and the resulting batches are shuffled again. Without shuffling
+    the whole dataset is sorted by length.
+
+    With world_size > 1 every process shuffles with the same seed (advanced every pass) and keeps
+    its share of the batches, see shard_batches.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=50, drop_last=False, rank=0, world_size=1, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+    def plan(self):
+        rng = np.random if self.world_size == 1 else np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        if self.shuffle:
+            order = rng.permutation(len(self.lengths))
+            span = self.batch_size * self.bucket_size
+            buckets = [order[i:i + span] for i in range(0, len(order), span)]
+            order = np.concatenate([b[np.argsort(self.lengths[b], kind='stable')] for b in buckets])
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            rng.shuffle(batches)
+        return [batch.tolist() for batch in shard_batches(batches, self.rank, self.world_size)]
+
+    def __len__(self):
+        if self.drop_last:
+            batches = len(self.lengths) // self.batch_size
+        else:
+            batches = math.ceil(len(self.lengths) / self.batch_size)
+        return math.ceil(batches / self.world_size)
+
+class ShardedBatchSampler(ResumableBatchSampler):
+    """Plain (not length-grouped) batch sampler for one of world_size processes: every process draws
+    the same seeded permutation per pass and keeps its share of the batches, see shard_batches.
+    A single process shuffles with the global numpy RNG instead."""
+    def __init__(self, num_examples, batch_size, shuffle=True, rank=0, world_size=1, seed=0):
+        self.num_examples = num_examples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+    def plan(self):
+        if self.shuffle:
+            rng = np.random if self.world_size == 1 else np.random.RandomState(self.seed + self.epoch)
+            order = rng.permutation(self.num_examples)
+        else:
+            order = np.arange(self.num_examples)
+        self.epoch += 1
+        batches = [order[i:i + self.batch_size] for i in range(0, self.num_examples, self.batch_size)]
+        return [batch.tolist() for batch in shard_batches(batches, self.rank, self.world_size)]
+
+    def __len__(self):
+        return math.ceil(math.ceil(self.num_examples / self.batch_size) / self.world_size)
+
+def build_loader(dataset, batch_size, shuffle=False, dynamic_padding=False, num_workers=0, pin_memory=False, rank=0, world_size=1, seed=0):
+    """world_size > 1 gives this process (rank) its own disjoint share of the batches."""
+    # workers are kept alive between passes, the DA trainers cycle over their loaders
+    worker_args = {'num_workers': num_workers, 'pin_memory': pin_memory, 'persistent_workers': num_workers > 0}
+    if dynamic_padding:
+        batch_sampler = LengthBucketSampler(dataset.lengths(), batch_size, shuffle=shuffle, rank=rank, world_size=world_size, seed=seed)
+    elif world_size > 1 or isinstance(dataset, ColumnDataset):
+        batch_sampler = ShardedBatchSampler(len(dataset), batch_size, shuffle=shuffle, rank=rank, world_size=world_size, seed=seed)
+    else:
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, **worker_args)
+
+    if isinstance(dataset, ColumnDataset):
+        # the dataset slices whole batches itself, batch_size=None turns off per-example collation
+        return DataLoader(dataset, sampler=batch_sampler, batch_size=None, **worker_args)
+    if not dynamic_padding:
+        return DataLoader(dataset, batch_sampler=batch_sampler, **worker_args)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=pad_collate, **worker_args)
+
 if __name__ == "__main__":
     #split_small('beauty')
     for domain_name in small_domain_names:
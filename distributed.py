@@ -0,0 +1,128 @@
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def init_distributed(backend='gloo'):
+    """Joins the process group described by the torchrun environment (RANK, WORLD_SIZE, MASTER_ADDR, ...).
+    Without it, or with a single process, nothing is initialized and training runs as before.
+    On CPU the cores of the box are split between its processes, torchrun would otherwise pin every
+    process to one thread. Returns (rank, world_size, device)."""
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+    if world_size > 1:
+        dist.init_process_group(backend=backend)
+        if device.type == 'cpu':
+            local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    return get_rank(), get_world_size(), device
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def shared_seed(seed=None):
+    """seed, or without one a seed drawn from numpy's RNG on the main process and broadcast, so that
+    all processes shard the same data order and an unseeded run still gets an order of its own.
+    A single process does not need one and gets 0."""
+    if seed is not None:
+        return seed
+    if not is_distributed():
+        return 0
+    seed = [int(np.random.randint(2 ** 31)) if is_main_process() else None]
+    dist.broadcast_object_list(seed, src=0)
+    return seed[0]
+
+def broadcast_parameters(model, src=0):
+    """Copies the parameters and buffers of rank src to every process, so all replicas start equal."""
+    if not is_distributed():
+        return
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        dist.broadcast(tensor.data, src)
+
+def all_reduce_gradients(model, bucket_bytes=25 << 20):
+    """Averages the parameter gradients over all processes, in flattened buckets of about bucket_bytes.
+
+    Called right before optimizer.step() instead of wrapping the model in DistributedDataParallel: the
+    DA trainers run several backward passes per step (domains, FreeLB ascent steps, gradient-cached
+    chunks) and autograd.grad ascent passes, which DDP's per-backward reducer does not fit. A missing
+    gradient is reduced as zeros so every process takes part in the same collectives."""
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    grads = []
+    for p in model.parameters():
+        if not p.requires_grad:
+            continue
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+        grads.append(p.grad)
+
+    bucket, size = [], 0
+    for grad in grads:
+        bucket.append(grad)
+        size += grad.numel() * grad.element_size()
+        if size >= bucket_bytes:
+            _all_reduce_bucket(bucket, world_size)
+            bucket, size = [], 0
+    if bucket:
+        _all_reduce_bucket(bucket, world_size)
+
+def _all_reduce_bucket(bucket, world_size):
+    flat = _flatten_dense_tensors(bucket)
+    dist.all_reduce(flat)
+    flat.div_(world_size)
+    for grad, reduced in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+        grad.copy_(reduced)
+
+class GatherLayer(torch.autograd.Function):
+    """all_gather that keeps the autograd graph: the backward sums the gradients every process
+    computed for the gathered tensor and hands each process the rows it contributed. Processes may
+    hold different numbers of rows (e.g. the last batch of an epoch)."""
+    @staticmethod
+    def forward(ctx, x):
+        world_size = get_world_size()
+        size = torch.tensor([x.shape[0]], device=x.device)
+        sizes = [torch.zeros_like(size) for _ in range(world_size)]
+        dist.all_gather(sizes, size)
+        sizes = [int(s) for s in sizes]
+        padded = x.new_zeros((max(sizes),) + x.shape[1:])
+        padded[:x.shape[0]] = x
+        gathered = [torch.empty_like(padded) for _ in range(world_size)]
+        dist.all_gather(gathered, padded.contiguous())
+        ctx.sizes = sizes
+        ctx.rank = get_rank()
+        return torch.cat([g[:s] for g, s in zip(gathered, sizes)], dim=0)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.contiguous()
+        dist.all_reduce(grad_output)
+        start = sum(ctx.sizes[:ctx.rank])
+        return grad_output[start:start + ctx.sizes[ctx.rank]]
+
+def all_gather_with_grad(x):
+    """Rows of x from every process, in rank order; x itself when not distributed."""
+    if get_world_size() == 1:
+        return x
+    return GatherLayer.apply(x)
@@ -0,0 +1,77 @@
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from metrics import StreamingMetrics
+
+
+# position of the class and domain logits in the output tuple of every model in model.py
+CLASS_LOGITS = 1
+DOMAIN_LOGITS = 3
+
+def token_budget_batches(lengths, max_tokens, max_rows=None):
+    """Example indices sorted by decreasing length and cut into batches whose padded size
+    (rows x longest row) stays within max_tokens, so short examples go in large batches."""
+    order = np.argsort(-np.asarray(lengths), kind='stable')
+    batches = []
+    start = 0
+    while start < len(order):
+        longest = max(int(lengths[order[start]]), 1)
+        rows = max(max_tokens // longest, 1)
+        if max_rows:
+            rows = min(rows, max_rows)
+        batches.append(order[start:start + rows].tolist())
+        start += rows
+    return batches
+
+
+class Evaluator(object):
+    """Inference over a ColumnDataset for the per-epoch evaluation of the trainers.
+
+    Examples are visited longest first in token-budget batches, every batch is cut to its longest
+    row instead of max_length, and the forward runs under inference_mode with only the heads that
+    are asked for. Predictions are scattered back to dataset order through the batch's idx. Like
+    the evaluation loops it replaces, it leaves the model in eval mode, so training goes on
+    without dropout after the first evaluation; restore_mode puts the model back into the
+    train/eval mode it came in.
+    """
+    def __init__(self, dataset, max_tokens=16384, num_workers=0, pin_memory=False, restore_mode=False):
+        self.dataset = dataset
+        self.restore_mode = restore_mode
+        self.batches = token_budget_batches(dataset.lengths(), max_tokens)
+        # the dataset gathers and pads whole batches itself, batch_size=None turns off collation
+        self.loader = DataLoader(dataset, sampler=self.batches, batch_size=None, num_workers=num_workers,
+                                 pin_memory=pin_memory, persistent_workers=num_workers > 0)
+
+    def predict(self, model, device, heads=('class',)):
+        """Argmax predictions {head: LongTensor[len(dataset)]} of the 'class' and/or 'domain' head, in dataset order."""
+        training = model.training
+        model.eval()
+        with torch.inference_mode():
+            predictions = {head: torch.empty(len(self.dataset), dtype=torch.long, device=device) for head in heads}
+            for batch in self.loader:
+                width = int(batch['attention_mask'].sum(dim=1).max())
+                input_ids = batch['input_ids'][:, :width].to(device, non_blocking=True)
+                attention_mask = batch['attention_mask'][:, :width].to(device, non_blocking=True)
+                idx = batch['idx'].to(device, non_blocking=True)
+                outputs = model(input_ids=input_ids, attention_mask=attention_mask, capture=(), heads=heads)
+                if 'class' in heads:
+                    predictions['class'][idx] = outputs[CLASS_LOGITS].argmax(dim=-1)
+                if 'domain' in heads:
+                    predictions['domain'][idx] = outputs[DOMAIN_LOGITS].argmax(dim=-1)
+        if self.restore_mode:
+            model.train(training)
+        return predictions
+
+    def evaluate(self, model, device, domain=None):
+        """Class metrics of the dataset, and with domain (the label of the whole split) also the
+        domain-classifier metrics from the same pass, as (class_scores, domain_scores)."""
+        heads = ('class',) if domain is None else ('class', 'domain')
+        predictions = self.predict(model, device, heads)
+        class_metric = StreamingMetrics(model.num_labels, device)
+        class_metric.add_batch(predictions=predictions['class'], references=self.dataset.labels)
+        if domain is None:
+            return class_metric.compute()
+        domain_metric = StreamingMetrics(2, device)
+        domain_metric.add_batch(predictions=predictions['domain'], references=domain)
+        return class_metric.compute(), domain_metric.compute()
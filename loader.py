@@ -0,0 +1,228 @@
+import queue
+import threading
+
+import torch
+import torch.nn.functional as F
+
+
+def parse_ratio(ratio):
+    """'1:2' -> [1, 2]"""
+    return [int(r) for r in ratio.split(':')]
+
+def concat_batches(batches):
+    # right-pad every field to the widest batch before concatenating the rows
+    if len(batches) == 1:
+        return batches[0]
+    merged = {}
+    for key in batches[0]:
+        values = [batch[key] for batch in batches]
+        if values[0].dim() > 1:
+            width = max(value.shape[1] for value in values)
+            values = [F.pad(value, (0, width - value.shape[1])) for value in values]
+        merged[key] = torch.cat(values, dim=0)
+    return merged
+
+class StreamPosition(object):
+    """Where a domain stream stands: the planned batches of its current pass, how many of them were
+    drawn, the sampler epoch after the pass was planned and the sampler's seed. Saved with the
+    training state so that a resumed run goes on within the same pass instead of drawing a fresh one."""
+    def __init__(self, batches, consumed, epoch, seed):
+        self.batches = batches
+        self.consumed = consumed
+        self.epoch = epoch
+        self.seed = seed
+
+    def state_dict(self):
+        return {'batches': self.batches, 'consumed': self.consumed, 'epoch': self.epoch, 'seed': self.seed}
+
+def resumable_sampler(loader):
+    """The loader's batch sampler if it can plan its passes (data_process.ResumableBatchSampler), else None."""
+    for sampler in (getattr(loader, 'batch_sampler', None), getattr(loader, 'sampler', None)):
+        if hasattr(sampler, 'plan'):
+            return sampler
+    return None
+
+class InfiniteLoader(object):
+    """Cycles over a DataLoader forever. Every new pass goes through the loader's sampler
+    again, so a shuffled loader is reshuffled instead of being replayed.
+
+    positioned() also yields the StreamPosition after every batch (None for a loader whose sampler
+    cannot plan its passes), and a position's state_dict passed as `resume` replays the rest of its
+    pass before the next ones are drawn."""
+    def __init__(self, loader, resume=None):
+        self.loader = loader
+        self.resume = resume
+
+    def positioned(self):
+        sampler = resumable_sampler(self.loader)
+        resume, self.resume = self.resume, None
+        while True:
+            position = None
+            if sampler is not None:
+                if resume is not None and resume['consumed'] < len(resume['batches']):
+                    start = resume['consumed']
+                    if sampler.world_size > 1:
+                        # the saved batches are the main process's share, the seeded pass is planned again for this
+                        # one, with the seed of the saved run (an unseeded run draws a new one, see shared_seed)
+                        sampler.seed = resume['seed']
+                        sampler.epoch = resume['epoch'] - 1
+                        batches = sampler.plan()
+                    else:
+                        batches = resume['batches']
+                        sampler.epoch = resume['epoch']
+                else:
+                    batches, start = sampler.plan(), 0
+                sampler.next_plan = (batches, start)
+            resume = None
+            empty = True
+            for i, batch in enumerate(self.loader):
+                empty = False
+                if sampler is not None:
+                    position = StreamPosition(batches, start + i + 1, sampler.epoch, sampler.seed)
+                yield batch, position
+            if empty:
+                raise ValueError("cannot cycle over an empty loader")
+
+    def __iter__(self):
+        for batch, position in self.positioned():
+            yield batch
+
+class MultiDomainIterator(object):
+    """Draws one batch per domain for every training step, e.g. a labeled source batch and an
+    unlabeled target batch, replacing zip(source_loader, target_loader).
+
+    Each domain stream cycles on its own and never runs out, so an epoch is simply a number of
+    steps chosen by the caller and a large target set is not truncated to the source size.
+    ratio gives how many loader batches are drawn from each domain per step, e.g. [1, 2] yields
+    target batches twice as large as the source ones. A background thread keeps up to
+    `prefetch` steps ready. Every batch carries the StreamPosition of its domain after it under
+    'position', and `resume` (one position state_dict or None per domain) continues the streams
+    of a saved run, see InfiniteLoader.
+    """
+    def __init__(self, loaders, ratio=None, prefetch=2, resume=None):
+        self.ratio = ratio or [1] * len(loaders)
+        assert len(self.ratio) == len(loaders), "need one ratio entry per domain"
+        resume = resume or [None] * len(loaders)
+        assert len(resume) == len(loaders), "need one resume entry per domain"
+        self.streams = [InfiniteLoader(loader, position).positioned() for loader, position in zip(loaders, resume)]
+        self.queue = queue.Queue(maxsize=max(prefetch, 1))
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _next_step(self):
+        step = []
+        for stream, n in zip(self.streams, self.ratio):
+            batches, positions = zip(*[next(stream) for _ in range(n)])
+            batch = dict(concat_batches(list(batches)))
+            batch['position'] = positions[-1]
+            step.append(batch)
+        return tuple(step)
+
+    def _produce(self):
+        try:
+            while not self.stop_event.is_set():
+                step = self._next_step()
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(step, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            self.queue.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        step = self.queue.get()
+        if isinstance(step, Exception):
+            raise step
+        return step
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join(timeout=1)
+
+def to_device(obj, device, non_blocking=False):
+    if torch.is_tensor(obj):
+        return obj.to(device, non_blocking=non_blocking)
+    if isinstance(obj, dict):
+        return {key: to_device(val, device, non_blocking) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_device(val, device, non_blocking) for val in obj)
+    return obj
+
+def pin(obj):
+    if torch.is_tensor(obj):
+        return obj if obj.is_pinned() else obj.pin_memory()
+    if isinstance(obj, dict):
+        return {key: pin(val) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(pin(val) for val in obj)
+    return obj
+
+class DeviceLoader(object):
+    """Moves the batches of a loader (or of any batch iterator, e.g. MultiDomainIterator) to
+    the device one step ahead of the consumer.
+
+    On CUDA the next batch is pinned and copied with non_blocking transfers on a side stream,
+    so the copy overlaps with the compute of the current step. On CPU batches pass through.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+
+    def _load(self, batch):
+        if not self.use_cuda:
+            return to_device(batch, self.device)
+        with torch.cuda.stream(self.stream):
+            return to_device(pin(batch), self.device, non_blocking=True)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        try:
+            next_batch = self._load(next(it))
+        except StopIteration:
+            return
+        while True:
+            if self.use_cuda:
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+                # the consumer's stream now owns the memory of the batch
+                for tensor in _tensors(next_batch):
+                    tensor.record_stream(torch.cuda.current_stream(self.device))
+            batch = next_batch
+            try:
+                next_batch = self._load(next(it))
+            except StopIteration:
+                yield batch
+                return
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
+
+def _tensors(obj):
+    if torch.is_tensor(obj):
+        yield obj
+    elif isinstance(obj, dict):
+        for val in obj.values():
+            yield from _tensors(val)
+    elif isinstance(obj, (list, tuple)):
+        for val in obj:
+            yield from _tensors(val)
+
+class DomainLabels(object):
+    """Constant domain-label tensors, built once per (batch size, domain) on the device."""
+    def __init__(self, device):
+        self.device = device
+        self.cache = {}
+
+    def __call__(self, batch_size, domain):
+        key = (batch_size, domain)
+        if key not in self.cache:
+            self.cache[key] = torch.full((batch_size,), domain, dtype=torch.long, device=self.device)
+        return self.cache[key]
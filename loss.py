@@ -1,6 +1,8 @@
+import copy
 import torch
 import torch.nn.functional as F
 from torch.nn.modules.loss import _Loss
+from torch.utils.checkpoint import checkpoint
 
 def stable_kl(logit, target, epsilon=1e-6, reduce=True):
     logit = logit.view(-1, logit.size(-1)).float()
@@ -72,4 +74,100 @@ class JSD(torch.nn.Module):
         m = F.softmax(logits_1, dim=-1) + F.softmax(logits_2, dim=-1)
         m = 0.5 * m
         loss = F.kl_div(F.log_softmax(logits_1, dim=-1), m, reduction='batchmean') + F.kl_div(F.log_softmax(logits_2, dim=-1), m, reduction='batchmean')
-        return 0.5 * loss
\ No newline at end of file
+        return 0.5 * loss
+
+class InfoNCELoss(torch.nn.Module):
+    """NT-Xent over two stacked views [z; z'] of shape (2B, D).
+
+    Row i's positive is row (i + B) % 2B and every other off-diagonal row is a
+    negative, which is the same objective as building positives/negatives with
+    boolean masks and feeding them to cross entropy with target 0. The diagonal
+    is knocked out in place and the positives are gathered, so no (2B, 2B)
+    index masks are materialized. With chunk_size the rows are processed in
+    slices under activation checkpointing, so only one (chunk, 2B) block of
+    similarities is alive at a time. negatives (K, D), e.g. from a
+    MomentumQueue, are appended to every row as extra negative columns.
+    """
+    def __init__(self, tau=0.12, chunk_size=None):
+        super().__init__()
+        self.tau = tau
+        self.chunk_size = chunk_size
+
+    def _rows(self, features, start, end, negatives=None):
+        n = features.shape[0]
+        sim = torch.matmul(features[start:end], features.T).float() / self.tau
+        if negatives is not None:
+            sim = torch.cat([sim, torch.matmul(features[start:end], negatives.T).float() / self.tau], dim=1)
+        sim.diagonal(offset=start).fill_(float('-inf'))
+        positive = (torch.arange(start, end, device=features.device) + n // 2) % n
+        positive = sim.gather(1, positive.unsqueeze(1)).squeeze(1)
+        return (torch.logsumexp(sim, dim=1) - positive).sum()
+
+    def forward(self, features, negatives=None):
+        n = features.shape[0]
+        assert n % 2 == 0, 'InfoNCELoss expects two stacked views'
+        features = F.normalize(features, dim=1)
+        chunk = self.chunk_size or n
+        if chunk >= n:
+            return self._rows(features, 0, n, negatives) / n
+        loss = 0
+        for start in range(0, n, chunk):
+            end = min(start + chunk, n)
+            loss = loss + checkpoint(self._rows, features, start, end, negatives, use_reentrant=False)
+        return loss / n
+
+
+class MomentumQueue(torch.nn.Module):
+    """MoCo-style negative queue for a projection head.
+
+    Keeps a momentum copy of the head and one on-device ring buffer of
+    normalized keys per domain. During a step the loss reads negatives(domain)
+    and stages the clean pooled outputs with push(); step() then moves the
+    copy towards the online head and enqueues the staged keys once, however
+    many times the loss ran in between (e.g. FreeLB ascent steps). Ring
+    pointers live on the host so nothing here waits on the device.
+    """
+    def __init__(self, encoder, size=4096, dim=None, domains=2, momentum=0.999):
+        super().__init__()
+        self.encoder = copy.deepcopy(encoder)
+        self.encoder.requires_grad_(False)
+        self.size = size
+        self.momentum = momentum
+        if dim is None:
+            # the key width is the output width of the head's last linear layer
+            dim = [m for m in encoder.modules() if isinstance(m, torch.nn.Linear)][-1].out_features
+        param = next(encoder.parameters())
+        self.register_buffer('queue', torch.zeros(domains, size, dim, dtype=param.dtype, device=param.device))
+        self.ptr = [0] * domains
+        self.filled = [0] * domains
+        self.pending = {}
+
+    def negatives(self, domain):
+        return self.queue[domain, :self.filled[domain]]
+
+    def push(self, domain, pooled):
+        self.pending[domain] = pooled.detach()
+
+    @torch.no_grad()
+    def enqueue(self, domain, keys):
+        keys = keys[-self.size:]
+        n = keys.shape[0]
+        end = self.ptr[domain] + n
+        if end <= self.size:
+            self.queue[domain, self.ptr[domain]:end] = keys
+        else:
+            split = self.size - self.ptr[domain]
+            self.queue[domain, self.ptr[domain]:] = keys[:split]
+            self.queue[domain, :n - split] = keys[split:]
+        self.ptr[domain] = end % self.size
+        self.filled[domain] = min(self.filled[domain] + n, self.size)
+
+    @torch.no_grad()
+    def step(self, online):
+        """Momentum update from the online head, then enqueue the keys staged since the last step."""
+        key_params = list(self.encoder.parameters())
+        torch._foreach_mul_(key_params, self.momentum)
+        torch._foreach_add_(key_params, [p.detach() for p in online.parameters()], alpha=1 - self.momentum)
+        for domain, pooled in self.pending.items():
+            self.enqueue(domain, F.normalize(self.encoder(pooled), dim=1))
+        self.pending = {}
@@ -0,0 +1,43 @@
+import torch
+
+
+class StreamingMetrics(object):
+    """Accuracy, macro-F1 and the confusion matrix of a classifier, accumulated on the device.
+
+    add_batch takes the predictions (or logits) and references of one batch and only adds their
+    bincount to an on-device confusion matrix, nothing is copied to the host until compute(), which
+    syncs once per evaluation. A constant reference, e.g. the domain label of a whole split, can be
+    given as a plain int. Drop-in for the datasets accuracy metric: compute()['accuracy'].
+    """
+    def __init__(self, num_classes, device=None):
+        self.num_classes = num_classes
+        self.confusion = torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)
+
+    def add_batch(self, predictions, references):
+        if predictions.dim() > 1:
+            predictions = predictions.argmax(dim=-1)
+        predictions = predictions.to(self.confusion.device, non_blocking=True)
+        if isinstance(references, int):
+            index = predictions + references * self.num_classes
+        else:
+            index = predictions + references.to(self.confusion.device, non_blocking=True) * self.num_classes
+        self.confusion += torch.bincount(index, minlength=self.num_classes * self.num_classes)
+
+    def reset(self):
+        self.confusion.zero_()
+
+    def compute(self):
+        # rows are references, columns predictions
+        confusion = self.confusion.view(self.num_classes, self.num_classes).cpu().double()
+        total = confusion.sum()
+        correct = confusion.diagonal()
+        support = confusion.sum(dim=1)
+        predicted = confusion.sum(dim=0)
+        # F1 = 2tp / (2tp + fp + fn), averaged over the classes that occur in the references or predictions
+        present = (support + predicted) > 0
+        f1 = 2 * correct / (support + predicted).clamp(min=1)
+        return {
+            'accuracy': (correct.sum() / total).item() if total > 0 else 0.0,
+            'macro_f1': f1[present].mean().item() if present.any() else 0.0,
+            'confusion_matrix': confusion.long().tolist(),
+        }
@@ -1,5 +1,6 @@
 import torch
 import math
+import copy
 from transformers import BertModel, AdamW, get_scheduler, BertForSequenceClassification, AutoTokenizer
 
 import torch.nn.functional as F
@@ -25,6 +26,54 @@ def attention(query, key, value, mask=None, prob_function = 'softmax'):
         p_attn = gumbels.softmax(dim=-1)
     return torch.matmul(p_attn, value), p_attn
 
+_shared_pretrained = {}
+
+def share_pretrained(name="bert-base-uncased"):
+    """Loads the pretrained weights once into shared memory. Processes forked afterwards (e.g. the
+    sweep workers) build their BERT from this copy instead of reading and deserializing the
+    checkpoint again, and the pages are not duplicated by reference counting."""
+    bert = BertModel.from_pretrained(name)
+    bert.share_memory()
+    _shared_pretrained[name] = bert
+
+def pretrained_bert(name="bert-base-uncased"):
+    """A trainable BERT with the pretrained weights, copied from the shared one when there is one."""
+    if name in _shared_pretrained:
+        return copy.deepcopy(_shared_pretrained[name])
+    return BertModel.from_pretrained(name)
+
+def topk_mask(scores, attention_mask, percentage):
+    """Marks the ceil(n_tokens * percentage) highest scoring positions of every row, where n_tokens
+    is the row's attention_mask sum, with one sort for the whole batch instead of a topk per row."""
+    top_k = torch.ceil(attention_mask.sum(-1).double() * percentage).long()
+    order = scores.argsort(dim=-1, descending=True)
+    positions = torch.arange(scores.shape[-1], device=scores.device).expand_as(order)
+    ranks = torch.empty_like(order).scatter_(-1, order, positions)
+    return (ranks < top_k.unsqueeze(-1)).long()
+
+DEFAULT_CAPTURE = ('pooled',)
+
+# output heads on top of the pooled output, a head left out of `heads` is not computed and returns None
+ALL_HEADS = ('class', 'domain', 'contrast')
+
+def capture_flags(capture):
+    """BERT output flags for a capture spec: the per-layer hidden states and attention maps are only
+    built (and kept alive in the autograd graph) when the call asks for them."""
+    return {'output_hidden_states': 'hidden_states' in capture, 'output_attentions': 'attentions' in capture}
+
+CAPTURE_FIELDS = {'pooled': 'pooler_output', 'hidden_states': 'hidden_states', 'attentions': 'attentions'}
+
+def detached(value):
+    if isinstance(value, (list, tuple)):
+        return type(value)(detached(v) for v in value)
+    return value.detach() if torch.is_tensor(value) else value
+
+def captured_outputs(outputs, capture):
+    """Collects the entries requested by a capture spec from the BERT outputs, detached: the module
+    keeps them until the next call, and with the graph attached they would keep that call's
+    activations alive (e.g. across FreeLB's retain_graph backward passes)."""
+    return {name: detached(getattr(outputs, CAPTURE_FIELDS[name])) for name in capture}
+
 class ReversalLayerF(Function):
     @staticmethod
     def forward(ctx, x, alpha):
@@ -42,9 +91,8 @@ class Bertbaseline(torch.nn.Module):
     def __init__(self, num_labels=3):
         super().__init__()
         self.num_labels = num_labels
-        self.bert = BertModel.from_pretrained("bert-base-uncased")
-        self.bert.config.output_hidden_states = True
-        self.bert.config.output_attentions = True
+        self.bert = pretrained_bert("bert-base-uncased")
+        self.captured = {}
         self.dropout = torch.nn.Dropout(0.1)
         self.class_classifier = torch.nn.Linear(768, self.num_labels)
         '''
@@ -59,22 +107,23 @@ class Bertbaseline(torch.nn.Module):
         self.class_classifier.add_module('c_fc2', torch.nn.Linear(100, num_labels))
         '''
 
-    def forward(self, input_ids=None, inputs_embeds=None, attention_mask=None, labels=None):
+    def forward(self, input_ids=None, inputs_embeds=None, attention_mask=None, labels=None, capture=DEFAULT_CAPTURE, heads=ALL_HEADS):
         if inputs_embeds == None:
-            outputs = self.bert(input_ids, attention_mask=attention_mask)
+            outputs = self.bert(input_ids, attention_mask=attention_mask, **capture_flags(capture))
         else:
-            outputs = self.bert(inputs_embeds=inputs_embeds, attention_mask=attention_mask)
+            outputs = self.bert(inputs_embeds=inputs_embeds, attention_mask=attention_mask, **capture_flags(capture))
         pooled_output = outputs[1]
 
         pooled_output = self.dropout(pooled_output)
         #logits = self.classifier(pooled_output)
-        logits = self.class_classifier(pooled_output)
+        logits = self.class_classifier(pooled_output) if 'class' in heads else None
 
         loss = None
-        if labels is not None:
+        if labels is not None and logits is not None:
             loss_fct = CrossEntropyLoss()
             loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
 
+        self.captured = captured_outputs(outputs, capture)
         return loss, logits, outputs.last_hidden_state, outputs.attentions
 
 
@@ -82,9 +131,8 @@ class BertDANN(torch.nn.Module):
     def __init__(self, num_labels = 3):
         super().__init__()
         self.num_labels = num_labels
-        self.bert = BertModel.from_pretrained("bert-base-uncased")
-        self.bert.config.output_hidden_states = True
-        self.bert.config.output_attentions = True
+        self.bert = pretrained_bert("bert-base-uncased")
+        self.captured = {}
         self.dropout = torch.nn.Dropout(0.1)
         self.class_classifier = torch.nn.Linear(768, self.num_labels)
         self.domain_classifier = torch.nn.Linear(768, 2)
@@ -103,25 +151,28 @@ class BertDANN(torch.nn.Module):
         #self.class_classifier.add_module('c_drop1', torch.nn.Dropout(0.1))
         self.domain_classifier.add_module('d_fc2', torch.nn.Linear(100, 2))
         '''
-    def forward(self, input_ids=None, attention_mask=None, class_labels=None, domain_labels=None, alpha=0):
-        outputs = self.bert(input_ids, attention_mask=attention_mask)
+    def forward(self, input_ids=None, attention_mask=None, class_labels=None, domain_labels=None, alpha=0, capture=DEFAULT_CAPTURE, heads=ALL_HEADS):
+        outputs = self.bert(input_ids, attention_mask=attention_mask, **capture_flags(capture))
         pooled_output = outputs[1]
         pooled_output = self.dropout(pooled_output)
-        reverse_pooled_output = ReversalLayerF.apply(pooled_output, alpha)
 
-        class_logits=self.class_classifier(pooled_output)
-        domain_logits=self.domain_classifier(reverse_pooled_output)
+        class_logits = self.class_classifier(pooled_output) if 'class' in heads else None
+        domain_logits = None
+        if 'domain' in heads:
+            reverse_pooled_output = ReversalLayerF.apply(pooled_output, alpha)
+            domain_logits = self.domain_classifier(reverse_pooled_output)
 
         class_loss = None
-        if class_labels is not None:
+        if class_labels is not None and class_logits is not None:
             class_loss_fct = CrossEntropyLoss()
             class_loss = class_loss_fct(class_logits.view(-1, self.num_labels), class_labels.view(-1))
 
         domain_loss = None
-        if domain_labels is not None:
+        if domain_labels is not None and domain_logits is not None:
             domain_loss_fct = CrossEntropyLoss()
             domain_loss = domain_loss_fct(domain_logits.view(-1,2), domain_labels.view(-1))
 
+        self.captured = captured_outputs(outputs, capture)
         return class_loss, class_logits, domain_loss, domain_logits, outputs.last_hidden_state, outputs.attentions
 
 
@@ -129,9 +180,8 @@ class BertAdvContrastSequenceClassification(torch.nn.Module):
     def __init__(self, num_labels=3):
         super().__init__()
         self.num_labels = num_labels
-        self.bert = BertModel.from_pretrained("bert-base-uncased")
-        self.bert.config.output_hidden_states = True
-        self.bert.config.output_attentions = True
+        self.bert = pretrained_bert("bert-base-uncased")
+        self.captured = {}
         #self.bert.config.type_vocab_size = 2
         #single_emb = self.bert.embeddings.token_type_embeddings
         #self.bert.embeddings.token_type_embeddings = torch.nn.Embedding(2, single_emb.embedding_dim)
@@ -163,28 +213,29 @@ class BertAdvContrastSequenceClassification(torch.nn.Module):
         #self.contrast_MLP.add_module('c_drop1', torch.nn.Dropout(0.1))
         #self.contrast_MLP.add_module('cm_fc2', torch.nn.Linear(768, 768))
 
-    def forward(self, input_ids=None, inputs_embeds=None, attention_mask=None, class_labels=None, domain_labels=None):
+    def forward(self, input_ids=None, inputs_embeds=None, attention_mask=None, class_labels=None, domain_labels=None, capture=DEFAULT_CAPTURE, heads=ALL_HEADS):
         if inputs_embeds == None:
-            outputs = self.bert(input_ids, attention_mask=attention_mask)
+            outputs = self.bert(input_ids, attention_mask=attention_mask, **capture_flags(capture))
         else:
-            outputs = self.bert(inputs_embeds=inputs_embeds, attention_mask=attention_mask)
+            outputs = self.bert(inputs_embeds=inputs_embeds, attention_mask=attention_mask, **capture_flags(capture))
         pooled_output = outputs[1]
 
-        class_logits=self.class_classifier(pooled_output)
-        domain_logits=self.domain_classifier(pooled_output)
+        class_logits = self.class_classifier(pooled_output) if 'class' in heads else None
+        domain_logits = self.domain_classifier(pooled_output) if 'domain' in heads else None
 
         class_loss = None
-        if class_labels is not None:
+        if class_labels is not None and class_logits is not None:
             class_loss_fct = CrossEntropyLoss()
             class_loss = class_loss_fct(class_logits.view(-1, self.num_labels), class_labels.view(-1))
 
         domain_loss = None
-        if domain_labels is not None:
+        if domain_labels is not None and domain_logits is not None:
             domain_loss_fct = CrossEntropyLoss()
             domain_loss = domain_loss_fct(domain_logits.view(-1,2), domain_labels.view(-1))
 
-        z = self.contrast_MLP(pooled_output)
+        z = self.contrast_MLP(pooled_output) if 'contrast' in heads else None
 
+        self.captured = captured_outputs(outputs, capture)
         return class_loss, class_logits, domain_loss, domain_logits, outputs.last_hidden_state, outputs.attentions, z
 
 
@@ -198,13 +249,10 @@ class BertContrastSequenceClassification(torch.nn.Module):
         self.mask_model = mask_model
         self.mask_percentage = mask_percentage
 
-        self.bert = BertModel.from_pretrained("bert-base-uncased")
-        self.bert.config.output_hidden_states = True
-        self.bert.config.output_attentions = True
+        self.bert = pretrained_bert("bert-base-uncased")
+        self.captured = {}
         if self.num_bert == 2:
-            self.bert2 = BertModel.from_pretrained("bert-base-uncased")
-            self.bert2.config.output_hidden_states = True
-            self.bert2.config.output_attentions = True
+            self.bert2 = pretrained_bert("bert-base-uncased")
 
         self.domain_embedding = torch.nn.Embedding(self.num_domains, 768)
 
@@ -221,10 +269,10 @@ class BertContrastSequenceClassification(torch.nn.Module):
         self.Relu = torch.nn.ReLU()
         self.tanh = torch.nn.Tanh()
 
-    def forward(self, input_ids=None, inputs_embeds=None, attention_mask=None, labels=None, train_mask=False, bp = True):
+    def forward(self, input_ids=None, inputs_embeds=None, attention_mask=None, labels=None, train_mask=False, bp = True, capture=DEFAULT_CAPTURE):
         if train_mask:
             if self.mask_model == "gumble":
-                outputs = self.bert(input_ids, attention_mask=attention_mask)
+                outputs = self.bert(input_ids, attention_mask=attention_mask, **capture_flags(capture))
                 last_hidden_state = outputs.last_hidden_state
 
                 domain_discripter = self.domain_embedding(labels)
@@ -262,13 +310,14 @@ class BertContrastSequenceClassification(torch.nn.Module):
                     loss_fct = CrossEntropyLoss()
                     loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
 
+                self.captured = captured_outputs(outputs, capture)
                 return loss, logits, text_mask, masked_sent_embeds
 
             elif self.mask_model == "attn":
                 if self.num_bert == 2:
-                    outputs = self.bert2(input_ids, attention_mask=attention_mask)
+                    outputs = self.bert2(input_ids, attention_mask=attention_mask, **capture_flags(capture))
                 else:
-                    outputs = self.bert(input_ids, attention_mask=attention_mask)
+                    outputs = self.bert(input_ids, attention_mask=attention_mask, **capture_flags(capture))
 
                 last_hidden_state = outputs.last_hidden_state
                 cls_emb = last_hidden_state[:, 0, :].unsqueeze(1)
@@ -282,12 +331,7 @@ class BertContrastSequenceClassification(torch.nn.Module):
                 device = attn_weight.device
                 # percentage
                 percentage = self.mask_percentage
-                text_mask = torch.zeros(attn_weight.shape).long().to(device)
-                for i in range(text_mask.shape[0]):
-                    top_k = attention_mask[i].sum().item() * percentage
-                    top_k = math.ceil(top_k)
-                    top_k_value, top_k_indices = torch.topk(attn_weight[i], top_k, dim=-1)
-                    text_mask[i, top_k_indices] = 1
+                text_mask = topk_mask(attn_weight, attention_mask, percentage)
 
                 text_mask_tmp = text_mask - attn_weight.detach() + attn_weight
                 text_mask_tmp = text_mask_tmp.unsqueeze(-1)
@@ -309,13 +353,14 @@ class BertContrastSequenceClassification(torch.nn.Module):
                     loss_fct = CrossEntropyLoss()
                     loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
 
+                self.captured = captured_outputs(outputs, capture)
                 return loss, logits, text_mask, masked_sent_embeds
 
             elif self.mask_model == "descriptor":
                 if self.num_bert == 2:
-                    outputs = self.bert2(input_ids, attention_mask=attention_mask)
+                    outputs = self.bert2(input_ids, attention_mask=attention_mask, **capture_flags(capture))
                 else:
-                    outputs = self.bert(input_ids, attention_mask=attention_mask)
+                    outputs = self.bert(input_ids, attention_mask=attention_mask, **capture_flags(capture))
 
                 last_hidden_state = outputs.last_hidden_state
                 domain_descripter = self.domain_embedding(labels)
@@ -357,12 +402,7 @@ class BertContrastSequenceClassification(torch.nn.Module):
                 # calculate the mask
                 percentage = self.mask_percentage
                 device = attn_weight.device
-                text_mask = torch.zeros(attn_weight.shape).long().to(device)
-                for i in range(text_mask.shape[0]):
-                    top_k = attention_mask[i].sum().item() * percentage
-                    top_k = math.ceil(top_k)
-                    top_k_value, top_k_indices = torch.topk(attn_weight[i], top_k, dim=-1)
-                    text_mask[i, top_k_indices] = 1
+                text_mask = topk_mask(attn_weight, attention_mask, percentage)
 
                 mask_code = torch.LongTensor([103]).to(device)
                 source_embeddings = self.bert.embeddings.word_embeddings(input_ids)
@@ -376,14 +416,15 @@ class BertContrastSequenceClassification(torch.nn.Module):
                 text_mask_tmp = text_mask_tmp.unsqueeze(-1)
                 masked_sent_embeds = maskcode_embeddings * text_mask_tmp + source_embeddings * (1 - text_mask_tmp)
 
+                self.captured = captured_outputs(outputs, capture)
                 return loss, logits, text_mask, masked_sent_embeds
 
 
             elif self.mask_model == "none":
                 if self.num_bert == 2:
-                    outputs = self.bert2(input_ids, attention_mask=attention_mask)
+                    outputs = self.bert2(input_ids, attention_mask=attention_mask, **capture_flags(capture))
                 else:
-                    outputs = self.bert(input_ids, attention_mask=attention_mask)
+                    outputs = self.bert(input_ids, attention_mask=attention_mask, **capture_flags(capture))
 
                 pooled_output = outputs[1]
 
@@ -407,21 +448,17 @@ class BertContrastSequenceClassification(torch.nn.Module):
                 device = attn_weight.device
                 # percentage
                 percentage = self.mask_percentage
-                text_mask = torch.zeros(attn_weight.shape).long().to(device)
-                for i in range(text_mask.shape[0]):
-                    top_k = attention_mask[i].sum().item() * percentage
-                    top_k = math.ceil(top_k)
-                    top_k_value, top_k_indices = torch.topk(attn_weight[i], top_k, dim=-1)
-                    text_mask[i, top_k_indices] = 1
+                text_mask = topk_mask(attn_weight, attention_mask, percentage)
 
                 masked_sent_embeds = None
 
+                self.captured = captured_outputs(outputs, capture)
                 return loss, logits, text_mask, masked_sent_embeds
         else:
             if inputs_embeds == None:
-                outputs = self.bert(input_ids, attention_mask=attention_mask)
+                outputs = self.bert(input_ids, attention_mask=attention_mask, **capture_flags(capture))
             else:
-                outputs = self.bert(inputs_embeds=inputs_embeds, attention_mask=attention_mask)
+                outputs = self.bert(inputs_embeds=inputs_embeds, attention_mask=attention_mask, **capture_flags(capture))
             last_hidden_state = outputs.last_hidden_state
 
             cls_emb = last_hidden_state[:, 0, :].unsqueeze(1)
@@ -441,4 +478,5 @@ class BertContrastSequenceClassification(torch.nn.Module):
                 loss_fct = CrossEntropyLoss()
                 loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
 
+            self.captured = captured_outputs(outputs, capture)
             return loss, logits, outputs.hidden_states, outputs.attentions, z
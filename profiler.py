@@ -0,0 +1,145 @@
+import contextlib
+import json
+import os
+import sys
+import time
+
+import torch
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    """Peak resident set size of this process so far in bytes, None where getrusage is missing."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class StepProfiler(object):
+    """Wall time and peak memory of the named phases of a training step.
+
+    with profiler.phase('source/forward'): ... times the block. On CUDA the block is bracketed by
+    two recorded CUDA events, which only enqueue a timestamp, and the events are resolved every
+    sync_every steps (and by summary()), so the instrumentation does not serialize the step. On
+    CPU the work is synchronous and perf_counter is used. Peak memory is the CUDA allocator's peak
+    within the phase; on CPU it is the process's peak RSS at the end of the phase, which cannot be
+    reset, so it is the high-water mark of the run up to that phase. Phases may nest. The Chrome trace keeps the phases of the first
+    trace_steps steps (all with None). Disabled, phase() is a no-op context.
+    """
+    def __init__(self, device, enabled=True, sync_every=50, trace_steps=None):
+        self.device = device
+        self.enabled = enabled
+        self.cuda = enabled and device.type == 'cuda'
+        self.sync_every = max(sync_every, 1)
+        self.trace_steps = trace_steps
+        self.steps = 0
+        self.stack = []
+        self.pending = []
+        self.trace = []
+        if self.cuda:
+            self.origin = torch.cuda.Event(enable_timing=True)
+            self.origin.record()
+        else:
+            self.origin = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        """Starts a new aggregation window, e.g. for every epoch."""
+        self.flush()
+        self.totals = {}
+        self.window_steps = 0
+
+    def _now(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        if self.cuda:
+            if self.stack:
+                self.stack[-1][1] = max(self.stack[-1][1], torch.cuda.max_memory_allocated(self.device))
+            torch.cuda.reset_peak_memory_stats(self.device)
+        frame = [name, 0]
+        self.stack.append(frame)
+        start = self._now()
+        try:
+            yield
+        finally:
+            end = self._now()
+            self.stack.pop()
+            if self.cuda:
+                peak = max(frame[1], torch.cuda.max_memory_allocated(self.device))
+                if self.stack:
+                    self.stack[-1][1] = max(self.stack[-1][1], peak)
+            else:
+                peak = peak_rss()
+            self.pending.append((name, self.steps, len(self.stack), start, end, peak))
+
+    def phase(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._phase(name)
+
+    def step(self):
+        """Marks the end of a training step."""
+        if not self.enabled:
+            return
+        self.steps += 1
+        self.window_steps += 1
+        if self.steps % self.sync_every == 0:
+            self.flush()
+
+    def flush(self):
+        """Resolves the recorded phases, the only point that waits for the device."""
+        if not self.pending:
+            return
+        if self.cuda:
+            self.pending[-1][4].synchronize()
+        for name, step, depth, start, end, peak in self.pending:
+            if self.cuda:
+                begin, seconds = self.origin.elapsed_time(start) / 1000, start.elapsed_time(end) / 1000
+            else:
+                begin, seconds = start - self.origin, end - start
+            total = self.totals.setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak': None})
+            total['calls'] += 1
+            total['seconds'] += seconds
+            if peak is not None:
+                total['peak'] = max(total['peak'] or 0, peak)
+            if self.trace_steps is None or step < self.trace_steps:
+                self.trace.append({'name': name, 'ph': 'X', 'ts': begin * 1e6, 'dur': seconds * 1e6, 'pid': os.getpid(),
+                                   'tid': depth, 'args': {'step': step, 'peak_mb': None if peak is None else peak / 2 ** 20}})
+        self.pending = []
+
+    def summary(self):
+        """Table of the phases of the current window: calls, total seconds, ms per step, and peak memory."""
+        if not self.enabled:
+            return ''
+        self.flush()
+        steps = max(self.window_steps, 1)
+        lines = ['{:<24} {:>7} {:>9} {:>10} {:>11}'.format('phase', 'calls', 'total s', 'ms/step', 'peak MB' if self.cuda else 'peak RSS MB')]
+        for name, total in self.totals.items():
+            peak = '-' if total['peak'] is None else '{:.0f}'.format(total['peak'] / 2 ** 20)
+            lines.append('{:<24} {:>7} {:>9.2f} {:>10.1f} {:>11}'.format(
+                name, total['calls'], total['seconds'], 1000 * total['seconds'] / steps, peak))
+        lines.append('{} steps'.format(self.window_steps))
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, path):
+        """Writes every resolved phase as a Chrome trace (chrome://tracing, Perfetto), one row per nesting depth."""
+        self.flush()
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'traceEvents': self.trace, 'displayTimeUnit': 'ms'}, f)
+        os.replace(tmp, path)
+
+
+# default of the functions that take an optional profiler
+NO_PROFILER = StepProfiler(torch.device('cpu'), enabled=False)
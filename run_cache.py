@@ -0,0 +1,94 @@
+import glob
+import hashlib
+import json
+import os
+import time
+
+from data_process import cache_key
+
+
+# where a run writes or how fast it gets there, not what it computes
+NON_SEMANTIC_ARGS = {'output_dir', 'ckpt_dir', 'cache_dir', 'adv_bank_dir', 'run_cache', 'num_workers', 'gpu', 'dist_backend',
+                     'ckpt_format', 'keep_best', 'save_every', 'resume',
+                     'profile', 'profile_sync_every', 'profile_trace', 'profile_trace_steps'}
+
+def code_version(root=os.path.dirname(os.path.abspath(__file__))):
+    """Hash of the package's python sources, so any edit to the training code gives new run keys."""
+    sha = hashlib.sha1()
+    for path in sorted(glob.glob(os.path.join(root, '*.py'))):
+        sha.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()[:20]
+
+def run_key(args, source, target, data_keys, version=None):
+    config = {name: value for name, value in sorted(vars(args).items()) if name not in NON_SEMANTIC_ARGS}
+    payload = json.dumps({'source': source, 'target': target, 'args': config, 'data': data_keys,
+                          'code': version or code_version()}, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()[:20]
+
+def pair_data_keys(source_data, target_data):
+    """Token cache keys (file content, tokenizer, max_length) of the splits a single-source run reads."""
+    splits = [(source_data, 'train'), (source_data, 'val'), (target_data, 'labeled'), (target_data, 'unlabeled')]
+    return {data.domain_name + '.' + split: cache_key(data.path(split), data.tokenizer_name, data.max_length)
+            for data, split in splits}
+
+def write_json(path, obj):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1, default=str)
+    os.replace(tmp, path)
+
+
+class Run(object):
+    """One cell of a sweep in the registry: run.json with the configuration, the per-epoch
+    accuracy curve, timings and the best checkpoint path. The trainer keeps the training state of
+    a partial run in the same directory, see checkpoint.AsyncCheckpointer."""
+    def __init__(self, path, record):
+        self.path = path
+        self.record = record
+
+    @property
+    def finished(self):
+        return self.record['status'] == 'finished'
+
+    def save(self):
+        write_json(os.path.join(self.path, 'run.json'), self.record)
+
+    def log_epoch(self, epoch, scores, seconds, best_checkpoint, best_acc):
+        self.record['curve'] = [entry for entry in self.record['curve'] if entry['epoch'] < epoch]
+        self.record['curve'].append(dict(scores, epoch=epoch, seconds=seconds))
+        self.record['best_checkpoint'] = best_checkpoint
+        self.record['best_acc'] = best_acc
+        self.save()
+
+    def finish(self, acc):
+        self.record.update(status='finished', acc=acc, finished_at=time.time())
+        self.record['seconds'] = sum(entry['seconds'] for entry in self.record['curve'])
+        self.save()
+
+
+class RunRegistry(object):
+    """Content-addressed store of training runs under root/<key>/, keyed by run_key."""
+    def __init__(self, root):
+        self.root = root
+
+    def lookup(self, key):
+        path = os.path.join(self.root, key, 'run.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return Run(os.path.dirname(path), json.load(f))
+
+    def open(self, key, source, target, args):
+        """The registered run of key, or a new one."""
+        run = self.lookup(key)
+        if run is not None:
+            return run
+        path = os.path.join(self.root, key)
+        os.makedirs(path, exist_ok=True)
+        config = {name: value for name, value in vars(args).items() if name not in NON_SEMANTIC_ARGS}
+        run = Run(path, {'key': key, 'source': source, 'target': target, 'args': config, 'status': 'running',
+                         'curve': [], 'best_checkpoint': None, 'best_acc': None, 'created_at': time.time()})
+        run.save()
+        return run
@@ -62,6 +62,8 @@ from transformers import glue_output_modes as output_modes
 from transformers import glue_processors as processors
 import pdb
 
+from adversarial import PerturbationEngine
+
 try:
     from torch.utils.tensorboard import SummaryWriter
 except ImportError:
@@ -190,6 +192,7 @@ def train(args, train_dataset, model, tokenizer, experiment=None):
         logger.info("  Will skip the first %d steps in the first epoch", steps_trained_in_current_epoch)
 
     tr_loss, logging_loss = 0.0, 0.0
+    adv_engine = PerturbationEngine.from_args(args, 'freelb')
     model.zero_grad()
     train_iterator = trange(
         epochs_trained, int(args.num_train_epochs), desc="Epoch", disable=args.local_rank not in [-1, 0],
@@ -221,87 +224,37 @@ def train(args, train_dataset, model, tokenizer, experiment=None):
                 )  # XLM, DistilBERT, RoBERTa, and XLM-RoBERTa don't use segment_ids
 
             # ============================ Code for adversarial training=============
-            # initialize delta
             if isinstance(model, torch.nn.DataParallel):
-                embeds_init = model.module.encoder.embeddings.word_embeddings(batch[0])
-            else:
-                embeds_init = model.encoder.embeddings.word_embeddings(batch[0])
-            if args.adv_init_mag > 0:
-
-                input_mask = inputs['attention_mask'].to(embeds_init)
-                input_lengths = torch.sum(input_mask, 1)
-                # check the shape of the mask here..
-
-                if args.norm_type == "l2":
-                    delta = torch.zeros_like(embeds_init).uniform_(-1,1) * input_mask.unsqueeze(2)
-                    dims = input_lengths * embeds_init.size(-1)
-                    mag = args.adv_init_mag / torch.sqrt(dims)
-                    delta = (delta * mag.view(-1, 1, 1)).detach()
-                elif args.norm_type == "linf":
-                    delta = torch.zeros_like(embeds_init).uniform_(-args.adv_init_mag,
-                                                                   args.adv_init_mag) * input_mask.unsqueeze(2)
-
+                word_embeddings = model.module.encoder.embeddings.word_embeddings
             else:
-                delta = torch.zeros_like(embeds_init)
+                word_embeddings = model.encoder.embeddings.word_embeddings
 
-            # the main loop
             dp_masks = None
-            for astep in range(args.adv_steps):
-                # (0) forward
-                delta.requires_grad_()
-                inputs['inputs_embeds'] = delta + embeds_init
+
+            def adv_loss_fn(inputs_embeds):
+                nonlocal dp_masks
+                inputs['inputs_embeds'] = inputs_embeds
                 inputs['dp_masks'] = dp_masks
 
                 outputs, dp_masks = model(**inputs)
                 loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
-                # (1) backward
                 if args.n_gpu > 1:
                     loss = loss.mean()  # mean() to average on multi-gpu parallel training
                 if args.gradient_accumulation_steps > 1:
                     loss = loss / args.gradient_accumulation_steps
+                return loss
 
-                loss = loss / args.adv_steps
-
-                tr_loss += loss.item()
-
+            def adv_backward(loss):
                 if args.fp16:
                     with amp.scale_loss(loss, optimizer) as scaled_loss:
                         scaled_loss.backward()
                 else:
                     loss.backward()
 
-                if astep == args.adv_steps - 1:
-                    # further updates on delta
-                    break
-
-                # (2) get gradient on delta
-                delta_grad = delta.grad.clone().detach()
-
-                # (3) update and clip
-                if args.norm_type == "l2":
-                    denorm = torch.norm(delta_grad.view(delta_grad.size(0), -1), dim=1).view(-1, 1, 1)
-                    denorm = torch.clamp(denorm, min=1e-8)
-                    delta = (delta + args.adv_lr * delta_grad / denorm).detach()
-                    if args.adv_max_norm > 0:
-                        delta_norm = torch.norm(delta.view(delta.size(0), -1).float(), p=2, dim=1).detach()
-                        exceed_mask = (delta_norm > args.adv_max_norm).to(embeds_init)
-                        reweights = (args.adv_max_norm / delta_norm * exceed_mask \
-                                     + (1-exceed_mask)).view(-1, 1, 1)
-                        delta = (delta * reweights).detach()
-                elif args.norm_type == "linf":
-                    denorm = torch.norm(delta_grad.view(delta_grad.size(0), -1), dim=1, p=float("inf")).view(-1, 1, 1)
-                    denorm = torch.clamp(denorm, min=1e-8)
-                    delta = (delta + args.adv_lr * delta_grad / denorm).detach()
-                    if args.adv_max_norm > 0:
-                        delta = torch.clamp(delta, -args.adv_max_norm, args.adv_max_norm).detach()
-                else:
-                    print("Norm type {} not specified.".format(args.norm_type))
-                    exit()
-
-                if isinstance(model, torch.nn.DataParallel):
-                    embeds_init = model.module.encoder.embeddings.word_embeddings(batch[0])
-                else:
-                    embeds_init = model.encoder.embeddings.word_embeddings(batch[0])
+            # the main loop, the loss of every ascent step is scaled by 1 / adv_steps
+            embeds_init, delta, loss = adv_engine.perturb(
+                lambda: word_embeddings(batch[0]), adv_loss_fn, inputs['attention_mask'], backward=adv_backward)
+            tr_loss += loss.item()
 
             # ============================ End (2) ==================
 
@@ -9,11 +9,13 @@ from sklearn import datasets
 from sklearn.manifold import TSNE
 from sklearn.svm import SVC
 
+from checkpoint import load_model_state
+
 def get_data(source_domain_name, target_domain_name, save_path):
     #save_path = "fig/DANN.best/" + source_domain_name + "-" + target_domain_name
-    features = torch.load(save_path + ".linear.analyze.features.pt").cpu().numpy()
-    class_labels = torch.load(save_path + ".linear.analyze.class.pt").cpu().numpy()
-    domain_labels = torch.load(save_path + ".linear.analyze.domain.pt").cpu().numpy()
+    features = load_model_state(save_path + ".linear.analyze.features.pt").numpy()
+    class_labels = load_model_state(save_path + ".linear.analyze.class.pt").numpy()
+    domain_labels = load_model_state(save_path + ".linear.analyze.domain.pt").numpy()
 
     n_samples, n_features = features.shape
     return features, class_labels, domain_labels, n_samples, n_features
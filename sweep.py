@@ -0,0 +1,150 @@
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import queue
+import time
+
+import numpy as np
+import torch
+
+from data_process import SmallDomainData
+from model import share_pretrained
+from run_cache import RunRegistry, run_key, pair_data_keys, code_version
+import train_contrast_freeLB
+
+
+small_domain_names = ['book', 'electronics', 'beauty', 'music']
+
+
+def available_cores():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+
+def core_sets(workers, threads):
+    """One set of `threads` cores per worker, disjoint as long as workers * threads fits the available cores."""
+    cores = available_cores()
+    return [[cores[(i * threads + j) % len(cores)] for j in range(threads)] for i in range(workers)]
+
+def warm_cache(domains, args):
+    """Tokenizes every split once in the parent, the workers then memory-map the same cache files
+    read-only instead of all tokenizing (and racing to write) them."""
+    for domain in domains:
+        data = SmallDomainData(domain, max_length=args.max_length, dynamic_padding=args.dynamic_padding, cache_dir=args.cache_dir)
+        for split in SmallDomainData.split_names:
+            if split == 'unlabeled' and args.stream_unlabeled:
+                continue
+            data.split(split)
+
+def init_worker(cores, threads):
+    try:
+        core_set = cores.get(timeout=1)
+    except queue.Empty:
+        # a replacement for a worker that died, its core set is gone with it
+        core_set = None
+    if core_set and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, core_set)
+    torch.set_num_threads(threads)
+
+def job_args(args, seed):
+    args = copy.deepcopy(args)
+    args.seed = seed
+    return args
+
+def finished_runs(jobs, args):
+    """Results of the jobs the run registry already holds finished runs for."""
+    registry = RunRegistry(args.run_cache)
+    version = code_version()
+    keys = {}
+    finished = {}
+    for source, target, seed, job_base_args in jobs:
+        if (source, target) not in keys:
+            keys[(source, target)] = pair_data_keys(
+                SmallDomainData(source, max_length=args.max_length, cache_dir=args.cache_dir),
+                SmallDomainData(target, max_length=args.max_length, cache_dir=args.cache_dir))
+        run = registry.lookup(run_key(job_args(args, seed), source, target, keys[(source, target)], version))
+        if run is not None and run.finished:
+            finished[(source, target, seed)] = {'source': source, 'target': target, 'seed': seed, 'acc': run.record['acc'],
+                                                'seconds': run.record['seconds'], 'cached': True}
+    return finished
+
+def run_job(job):
+    source, target, seed, args = job
+    args = job_args(args, seed)
+    # runs of the same pair with different seeds must not overwrite each other's files
+    args.ckpt_dir = os.path.join(args.ckpt_dir, 'seed{}'.format(seed))
+    os.makedirs(args.ckpt_dir, exist_ok=True)
+    if args.adv_bank_dir:
+        args.adv_bank_dir = os.path.join(args.adv_bank_dir, '{}-{}.seed{}'.format(source, target, seed))
+    start = time.time()
+    acc = train_contrast_freeLB.train_single_source(source, target, args)
+    return {'source': source, 'target': target, 'seed': seed, 'acc': acc,
+            'seconds': time.time() - start, 'pid': os.getpid()}
+
+def parse_pairs(pairs):
+    """'electronics-book,music-beauty' -> [('electronics', 'book'), ('music', 'beauty')], empty for all 12 pairs"""
+    if not pairs:
+        return [(s, t) for t in small_domain_names for s in small_domain_names if s != t]
+    return [tuple(pair.split('-')) for pair in pairs.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel sweep of train_contrast_freeLB over domain pairs and seeds. '
+                                                 'Arguments not listed here are passed on to the trainer.')
+    parser.add_argument('--pairs', type=str, default='',
+                        help='comma separated source-target pairs, all 12 pairs by default')
+    parser.add_argument('--seeds', type=int, default=5,
+                        help='number of seeds per pair')
+    parser.add_argument('--first_seed', type=int, default=0,
+                        help='seed of the first run of every pair')
+    parser.add_argument('--threads_per_worker', type=int, default=4,
+                        help='cores pinned to every worker process')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of worker processes, all available cores / threads_per_worker by default')
+    parser.add_argument('--results', type=str, default='./results/sweep.jsonl',
+                        help='file every finished run is appended to as one json line')
+    sweep_args, trainer_argv = parser.parse_known_args()
+    args = train_contrast_freeLB.get_parser().parse_args(trainer_argv)
+    if not args.cache_dir:
+        parser.error('the sweep shares the token cache between workers, --cache_dir must be set')
+
+    pairs = parse_pairs(sweep_args.pairs)
+    threads = sweep_args.threads_per_worker
+    workers = sweep_args.workers or max(1, len(available_cores()) // threads)
+    jobs = [(source, target, sweep_args.first_seed + i, args) for source, target in pairs for i in range(sweep_args.seeds)]
+
+    accs = {}
+    if args.run_cache:
+        # cells that already finished with this exact configuration, data and code are reported, not rerun
+        finished = finished_runs(jobs, args)
+        for result in finished.values():
+            accs.setdefault((result['source'], result['target']), []).append(result['acc'])
+            print(result)
+        jobs = [job for job in jobs if tuple(job[:3]) not in finished]
+
+    warm_cache(sorted({domain for source, target, seed, job_base_args in jobs for domain in (source, target)}), args)
+    if jobs:
+        share_pretrained()
+
+    os.makedirs(os.path.dirname(sweep_args.results) or '.', exist_ok=True)
+    # fork, so the workers inherit the shared pretrained weights instead of loading their own
+    context = multiprocessing.get_context('fork')
+    cores = context.Queue()
+    for core_set in core_sets(workers, threads):
+        cores.put(core_set)
+
+    print('{} runs on {} workers x {} threads'.format(len(jobs), workers, threads))
+    with context.Pool(workers, initializer=init_worker, initargs=(cores, threads)) as pool, \
+            open(sweep_args.results, 'a') as results:
+        for result in pool.imap_unordered(run_job, jobs):
+            results.write(json.dumps(result) + '\n')
+            results.flush()
+            accs.setdefault((result['source'], result['target']), []).append(result['acc'])
+            print(result)
+
+    for (source, target), acc_list in accs.items():
+        acc_array = np.array(acc_list)
+        print(source, target, acc_array, np.average(acc_array), np.std(acc_array))
+
+
+if __name__ == "__main__":
+    main()
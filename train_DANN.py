@@ -1,17 +1,22 @@
 import torch
 import argparse
 import os
+import random
 from pathlib import Path
 import numpy as np
-from data_process import process_small_data, myDataset, myDataset_unlabel
+from data_process import SmallDomainData, build_loader
+from loader import MultiDomainIterator, DeviceLoader, DomainLabels, parse_ratio
 from model import  Bertbaseline, BertDANN
+from distributed import init_distributed, cleanup_distributed, get_rank, get_world_size, is_main_process, shared_seed, \
+    broadcast_parameters, all_reduce_gradients
 from torch.utils.data import DataLoader, SubsetRandomSampler
 from transformers import BertModel, AdamW, get_scheduler, AutoModelForSequenceClassification, AutoTokenizer
 
 import torch.nn.functional as F
 
 from tqdm.auto import tqdm
-from datasets import load_metric
+from evaluate import Evaluator
+from checkpoint import CKPT_FORMATS, save_model_state
 
 seed = 3473497
 torch.cuda.manual_seed(seed)
@@ -22,6 +27,8 @@ parser.add_argument('--output_dir', type=str, default='./results',
                     help='location of the output dir')
 parser.add_argument('--ckpt_dir', type=str, default='./checkpoints',
                     help='location of the checkpoint dir')
+parser.add_argument('--ckpt_format', type=str, default='full', choices=CKPT_FORMATS,
+                    help='format of the saved model checkpoints: full (fp32 torch.save), or the opt-in compact fp16 or delta (int8 delta against the pretrained BERT), see checkpoint.py')
 parser.add_argument('--task_type', type=str, default='in_domain',
                     help='task type, in_domain, single_source, multi_source, DA')
 parser.add_argument('--dataset', type=str, default='amazon',
@@ -58,12 +65,32 @@ parser.add_argument('--load_from_pretrain', action='store_true',
                     help='if load from a pretrained domain classifier')
 parser.add_argument('--max_length', type=int, default=512,
                     help='max length')
+parser.add_argument('--dynamic_padding', action='store_true',
+                    help='pad each batch to its longest sequence and batch examples of similar length together')
+parser.add_argument('--cache_dir', type=str, default='data/cache',
+                    help='location of the memory-mapped tokenization cache, empty to tokenize on every run')
+parser.add_argument('--eval_max_tokens', type=int, default=16384,
+                    help='padded tokens per evaluation batch, examples are batched longest first under this budget')
+parser.add_argument('--restore_train_mode', action='store_true',
+                    help='put the model back into train mode (dropout on) after every evaluation, by default it stays in eval mode as it always did')
+parser.add_argument('--num_workers', type=int, default=0,
+                    help='number of data loader worker processes')
+parser.add_argument('--stream_unlabeled', action='store_true',
+                    help='read and tokenize the target unlabeled file as a stream instead of loading it')
+parser.add_argument('--dist_backend', type=str, default='gloo',
+                    help='torch.distributed backend when launched with torchrun (gloo runs on CPU)')
+parser.add_argument('--domain_ratio', type=str, default='1:1',
+                    help='source:target number of loader batches drawn per step')
+parser.add_argument('--seed', type=int, default=None,
+                    help='seed of torch, numpy and random for this run, by default the fixed seeds above and a data order drawn per run')
 
 args = parser.parse_args()
 
 small_domain_names = ['book', 'electronics', 'beauty', 'music']
 
-torch.cuda.set_device(args.gpu)
+rank, world_size, device = init_distributed(args.dist_backend)
+if world_size == 1 and torch.cuda.is_available():
+    torch.cuda.set_device(args.gpu)
 
 def sample_batch(dataset, sample_size = args.sample_size):
     loader = DataLoader(dataset, batch_size=sample_size, shuffle=True)
@@ -73,19 +100,28 @@ def sample_batch(dataset, sample_size = args.sample_size):
     return batch
 
 def train_single_source(source_domain_name, target_domain_name):
-    s_labeled_encodings, s_labeled_labels, s_train_encodings, s_train_labels, s_val_encodings, s_val_labels, s_unlabeled_encodings = process_small_data(source_domain_name, max_length=args.max_length)
-    s_train_dataset = myDataset(s_train_encodings, s_train_labels)
-    s_val_dataset = myDataset(s_val_encodings, s_val_labels)
-    s_unlabeled_dataset = myDataset_unlabel(s_unlabeled_encodings)
-
-    t_labeled_encodings, t_labeled_labels, t_train_encodings, t_train_labels, t_val_encodings, t_val_labels, t_unlabeled_encodings = process_small_data(target_domain_name, max_length=args.max_length)
-    t_labeled_dataset = myDataset(t_labeled_encodings, t_labeled_labels)
-    t_unlabeled_dataset = myDataset_unlabel(t_unlabeled_encodings)
-
-    source_train_loader = DataLoader(s_train_dataset, batch_size=args.batch_size, shuffle=True)
-    source_val_loader = DataLoader(s_val_dataset, batch_size=args.batch_size)
-    target_unlabeled_loader = DataLoader(t_unlabeled_dataset, batch_size=args.batch_size, shuffle=True)
-    target_test_loader = DataLoader(t_labeled_dataset, batch_size=args.batch_size)
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+    source_data = SmallDomainData(source_domain_name, max_length=args.max_length, dynamic_padding=args.dynamic_padding, cache_dir=args.cache_dir)
+    s_train_dataset = source_data.dataset('train')
+    s_val_dataset = source_data.dataset('val')
+
+    target_data = SmallDomainData(target_domain_name, max_length=args.max_length, dynamic_padding=args.dynamic_padding, cache_dir=args.cache_dir)
+    t_labeled_dataset = target_data.dataset('labeled')
+
+    # training batches are sharded over the processes, evaluation runs on the main process only
+    rank, world_size = get_rank(), get_world_size()
+    data_seed = shared_seed(args.seed)
+    pin_memory = torch.cuda.is_available()
+    source_train_loader = build_loader(s_train_dataset, args.batch_size, shuffle=True, dynamic_padding=args.dynamic_padding, num_workers=args.num_workers, pin_memory=pin_memory, rank=rank, world_size=world_size, seed=data_seed)
+    source_evaluator = Evaluator(s_val_dataset, args.eval_max_tokens, num_workers=args.num_workers, pin_memory=pin_memory, restore_mode=args.restore_train_mode)
+    if args.stream_unlabeled:
+        target_unlabeled_loader = DataLoader(target_data.unlabeled_stream(args.batch_size, rank=rank, world_size=world_size), batch_size=None, num_workers=args.num_workers, pin_memory=pin_memory)
+    else:
+        target_unlabeled_loader = build_loader(target_data.dataset('unlabeled'), args.batch_size, shuffle=True, dynamic_padding=args.dynamic_padding, num_workers=args.num_workers, pin_memory=pin_memory, rank=rank, world_size=world_size, seed=data_seed)
+    target_evaluator = Evaluator(t_labeled_dataset, args.eval_max_tokens, num_workers=args.num_workers, pin_memory=pin_memory, restore_mode=args.restore_train_mode)
 
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
@@ -106,29 +142,33 @@ def train_single_source(source_domain_name, target_domain_name):
     )
 
     model.to(device)
-    progress_bar = tqdm(range(num_training_steps))
+    broadcast_parameters(model)
+    progress_bar = tqdm(range(num_training_steps), disable=not is_main_process())
     s_acc = 0
     t_acc = 0
     # ---training---
     model.train()
+    domain_iter = MultiDomainIterator([source_train_loader, target_unlabeled_loader], ratio=parse_ratio(args.domain_ratio))
+    device_iter = iter(DeviceLoader(domain_iter, device))
+    domain_label_cache = DomainLabels(device)
     for epoch in range(args.epochs):
-        i = 0
-        for s_l_batch, t_ul_batch in zip(source_train_loader, target_unlabeled_loader):
+        for i in range(len(source_train_loader)):
+            s_l_batch, t_ul_batch = next(device_iter)
             #s_ul_batch = sample_batch(s_unlabeled_dataset, sample_size=args.sample_size)
             #t_ul_batch = sample_batch(t_unlabeled_dataset, sample_size=args.sample_size)
 
-            s_l_input_ids = s_l_batch['input_ids'].to(device)
-            s_l_attention_mask = s_l_batch['attention_mask'].to(device)  # [8, 128]
-            s_l_labels = s_l_batch['labels'].to(device)
-            s_l_domain_labels = torch.zeros(s_l_input_ids.shape[0]).long().to(device)
+            s_l_input_ids = s_l_batch['input_ids']
+            s_l_attention_mask = s_l_batch['attention_mask']  # [8, 128]
+            s_l_labels = s_l_batch['labels']
+            s_l_domain_labels = domain_label_cache(s_l_input_ids.shape[0], 0)
 
             #s_ul_input_ids = s_ul_batch['input_ids'].to(device)
             #s_ul_attention_mask = s_ul_batch['attention_mask'].to(device)
             #s_ul_domain_labels = torch.zeros(s_ul_input_ids.shape[0]).long().to(device)
 
-            t_ul_input_ids = t_ul_batch['input_ids'].to(device)
-            t_ul_attention_mask = t_ul_batch['attention_mask'].to(device)
-            t_ul_domain_labels = torch.ones(t_ul_input_ids.shape[0]).long().to(device)
+            t_ul_input_ids = t_ul_batch['input_ids']
+            t_ul_attention_mask = t_ul_batch['attention_mask']
+            t_ul_domain_labels = domain_label_cache(t_ul_input_ids.shape[0], 1)
 
 
             start_steps = epoch * len(source_train_loader)
@@ -181,67 +221,19 @@ def train_single_source(source_domain_name, target_domain_name):
             #loss = s_l_class_loss + s_l_domain_loss + s_ul_domain_loss + t_ul_domain_loss
             #loss.backward()
 
+            all_reduce_gradients(model)
             optimizer.step()
             lr_scheduler.step()
             optimizer.zero_grad()
             progress_bar.update(1)
-            i += 1
 
         # ----------validation----------
-        metric_val = load_metric("accuracy")
-        metric_val_domain = load_metric("accuracy")
-        model.eval()
-
-        for batch in source_val_loader:
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)
-            class_labels = batch['labels'].to(device)
-            domain_labels = torch.zeros(input_ids.shape[0]).long().to(device)
-            with torch.no_grad():
-                class_loss, class_logits, domain_loss, domain_logits, hidden_states, attentions = model(
-                    input_ids=input_ids,
-                    attention_mask=attention_mask,
-                    class_labels=class_labels,
-                    domain_labels=domain_labels,
-                    alpha=0.5
-                )
-
-            predictions = torch.argmax(class_logits, dim=-1)
-            metric_val.add_batch(predictions=predictions, references=batch["labels"])
-            domain_predictions = torch.argmax(domain_logits, dim=-1)
-            metric_val_domain.add_batch(predictions=domain_predictions,
-                                        references=torch.zeros(input_ids.shape[0]).long())
-
-        s_score = metric_val.compute()
-        s_domain_score = metric_val_domain.compute()
+        if not is_main_process():
+            continue
+        s_score, s_domain_score = source_evaluator.evaluate(model, device, domain=0)
 
         # ----------testing----------
-        metric_test = load_metric("accuracy")
-        metric_test_domain = load_metric("accuracy")
-        model.eval()
-
-        for batch in target_test_loader:
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)
-            class_labels = batch['labels'].to(device)
-            domain_labels = torch.ones(input_ids.shape[0]).long().to(device)
-            with torch.no_grad():
-                class_loss, class_logits, domain_loss, domain_logits, hidden_states, attentions = model(
-                    input_ids=input_ids,
-                    attention_mask=attention_mask,
-                    class_labels=class_labels,
-                    domain_labels=domain_labels,
-                    alpha=0.5
-                )
-
-            predictions = torch.argmax(class_logits, dim=-1)
-            metric_test.add_batch(predictions=predictions, references=batch["labels"])
-            domain_predictions = torch.argmax(domain_logits, dim=-1)
-            metric_test_domain.add_batch(predictions=domain_predictions,
-                                         references=torch.ones(input_ids.shape[0]).long())
-
-        t_score = metric_test.compute()
-        t_domain_score = metric_test_domain.compute()
+        t_score, t_domain_score = target_evaluator.evaluate(model, device, domain=1)
 
         print(source_domain_name, target_domain_name, s_score, s_domain_score, t_score, t_domain_score)
 
@@ -249,17 +241,21 @@ def train_single_source(source_domain_name, target_domain_name):
             s_acc = s_score['accuracy']
             t_acc = t_score['accuracy']
             checkpoint_path = args.ckpt_dir + "/" + source_domain_name + "-" + target_domain_name + ".linear.DANN.best.analyze.ckpt"
-            torch.save(model.state_dict(), checkpoint_path)
+            save_model_state(model.state_dict(), checkpoint_path, args.ckpt_format)
 
+    domain_iter.close()
+    if not is_main_process():
+        return t_acc
     print (s_acc, t_acc)
 
     checkpoint_path = args.ckpt_dir + "/" + source_domain_name + "-" + target_domain_name + ".linear.DANN.worst.analyze.ckpt"
-    torch.save(model.state_dict(), checkpoint_path)
+    save_model_state(model.state_dict(), checkpoint_path, args.ckpt_format)
     return t_acc
 
 
 if __name__ == "__main__":
     train_single_source('electronics', 'book')
+    cleanup_distributed()
 
     '''
     for target_domain_name in small_domain_names:
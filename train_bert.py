@@ -3,7 +3,8 @@ import argparse
 import os
 from pathlib import Path
 import numpy as np
-from data_process import process_small_data, myDataset
+from data_process import SmallDomainData, build_loader
+from loader import DeviceLoader
 from model import  Bertbaseline, BertContrastSequenceClassification
 from torch.utils.data import DataLoader, SubsetRandomSampler
 from transformers import BertModel, AdamW, get_scheduler, AutoModelForSequenceClassification, AutoTokenizer
@@ -11,7 +12,8 @@ from transformers import BertModel, AdamW, get_scheduler, AutoModelForSequenceCl
 import torch.nn.functional as F
 
 from tqdm.auto import tqdm
-from datasets import load_metric
+from evaluate import Evaluator
+from checkpoint import CKPT_FORMATS, save_model_state
 
 
 parser = argparse.ArgumentParser(description='PyTorch BERT Text Classification')
@@ -19,6 +21,8 @@ parser.add_argument('--output_dir', type=str, default='./results',
                     help='location of the output dir')
 parser.add_argument('--ckpt_dir', type=str, default='./checkpoints',
                     help='location of the checkpoint dir')
+parser.add_argument('--ckpt_format', type=str, default='full', choices=CKPT_FORMATS,
+                    help='format of the saved model checkpoints: full (fp32 torch.save), or the opt-in compact fp16 or delta (int8 delta against the pretrained BERT), see checkpoint.py')
 parser.add_argument('--task_type', type=str, default='in_domain',
                     help='task type, in_domain, single_source, multi_source, DA')
 parser.add_argument('--dataset', type=str, default='amazon',
@@ -55,6 +59,16 @@ parser.add_argument('--load_from_pretrain', action='store_true',
                     help='if load from a pretrained domain classifier')
 parser.add_argument('--max_length', type=int, default=512,
                     help='max length')
+parser.add_argument('--dynamic_padding', action='store_true',
+                    help='pad each batch to its longest sequence and batch examples of similar length together')
+parser.add_argument('--cache_dir', type=str, default='data/cache',
+                    help='location of the memory-mapped tokenization cache, empty to tokenize on every run')
+parser.add_argument('--eval_max_tokens', type=int, default=16384,
+                    help='padded tokens per evaluation batch, examples are batched longest first under this budget')
+parser.add_argument('--restore_train_mode', action='store_true',
+                    help='put the model back into train mode (dropout on) after every evaluation, by default it stays in eval mode as it always did')
+parser.add_argument('--num_workers', type=int, default=0,
+                    help='number of data loader worker processes')
 
 args = parser.parse_args()
 
@@ -66,17 +80,18 @@ torch.cuda.set_device(args.gpu)
 
 
 def train_in_domain(domain_name):
-    labeled_encodings, labeled_labels, train_encodings, train_labels, val_encodings, val_labels, unlabeled_encodings = process_small_data(domain_name)
-    train_dataset = myDataset(train_encodings, train_labels)
-    val_dataset = myDataset(val_encodings, val_labels)
+    data = SmallDomainData(domain_name, max_length=args.max_length, dynamic_padding=args.dynamic_padding, cache_dir=args.cache_dir)
+    train_dataset = data.dataset('train')
+    val_dataset = data.dataset('val')
 
 
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
     model = Bertbaseline(num_labels=3)
 
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
-    test_loader = DataLoader(val_dataset, batch_size=args.batch_size)
+    pin_memory = torch.cuda.is_available()
+    train_loader = build_loader(train_dataset, args.batch_size, shuffle=True, dynamic_padding=args.dynamic_padding, num_workers=args.num_workers, pin_memory=pin_memory)
+    test_evaluator = Evaluator(val_dataset, args.eval_max_tokens, num_workers=args.num_workers, pin_memory=pin_memory, restore_mode=args.restore_train_mode)
 
     #---optimizer---
     optimizer = AdamW(model.parameters(), lr=args.lr)
@@ -95,11 +110,11 @@ def train_in_domain(domain_name):
     #---training---
     model.train()
     for epoch in range(args.epochs):
-        for batch in train_loader:
+        for batch in DeviceLoader(train_loader, device):
             #optimizer.zero_grad()
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device) #[8, 128]
-            labels = batch['labels'].to(device)
+            input_ids = batch['input_ids']
+            attention_mask = batch['attention_mask'] #[8, 128]
+            labels = batch['labels']
             #outputs = model(input_ids, attention_mask=attention_mask, labels=labels)
             loss, logits, hidden_states, attentions = model(input_ids=input_ids, attention_mask=attention_mask, labels=labels)
 
@@ -111,41 +126,30 @@ def train_in_domain(domain_name):
             progress_bar.update(1)
 
         #---evaluation---
-        metric = load_metric("accuracy")
-        model.eval()
-        for batch in test_loader:
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)
-            labels = batch['labels'].to(device)
-            with torch.no_grad():
-                loss, logits, hidden_states, attentions = model(input_ids=input_ids, attention_mask=attention_mask, labels=labels)
-
-            predictions = torch.argmax(logits, dim=-1)
-            metric.add_batch(predictions=predictions, references=batch["labels"])
-
-        score = metric.compute()
+        score = test_evaluator.evaluate(model, device)
 
         print(domain_name, score)
 
         if score['accuracy'] >= acc:
             acc = score['accuracy']
             checkpoint_path = args.ckpt_dir + "/" + domain_name + "bert-baseline.ckpt"
-            torch.save(model.state_dict(), checkpoint_path)
+            save_model_state(model.state_dict(), checkpoint_path, args.ckpt_format)
 
     return
 
 def train_single_source(source_domain_name, target_domain_name):
-    s_labeled_encodings, s_labeled_labels, s_train_encodings, s_train_labels, s_val_encodings, s_val_labels, s_unlabeled_encodings = process_small_data(source_domain_name, max_length=args.max_length)
-    s_train_dataset = myDataset(s_train_encodings, s_train_labels)
-    s_val_dataset = myDataset(s_val_encodings, s_val_labels)
+    source_data = SmallDomainData(source_domain_name, max_length=args.max_length, dynamic_padding=args.dynamic_padding, cache_dir=args.cache_dir)
+    s_train_dataset = source_data.dataset('train')
+    s_val_dataset = source_data.dataset('val')
 
 
-    t_labeled_encodings, t_labeled_labels, t_train_encodings, t_train_labels, t_val_encodings, t_val_labels, t_unlabeled_encodings = process_small_data(target_domain_name, max_length=args.max_length)
-    t_labeled_dataset = myDataset(t_labeled_encodings, t_labeled_labels)
+    target_data = SmallDomainData(target_domain_name, max_length=args.max_length, dynamic_padding=args.dynamic_padding, cache_dir=args.cache_dir)
+    t_labeled_dataset = target_data.dataset('labeled')
 
-    source_train_loader = DataLoader(s_train_dataset, batch_size=args.batch_size, shuffle=True)
-    source_val_loader = DataLoader(s_val_dataset, batch_size=args.batch_size)
-    target_test_loader = DataLoader(t_labeled_dataset, batch_size=args.batch_size)
+    pin_memory = torch.cuda.is_available()
+    source_train_loader = build_loader(s_train_dataset, args.batch_size, shuffle=True, dynamic_padding=args.dynamic_padding, num_workers=args.num_workers, pin_memory=pin_memory)
+    source_evaluator = Evaluator(s_val_dataset, args.eval_max_tokens, num_workers=args.num_workers, pin_memory=pin_memory, restore_mode=args.restore_train_mode)
+    target_evaluator = Evaluator(t_labeled_dataset, args.eval_max_tokens, num_workers=args.num_workers, pin_memory=pin_memory, restore_mode=args.restore_train_mode)
 
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
@@ -172,11 +176,11 @@ def train_single_source(source_domain_name, target_domain_name):
     # ---training---
     model.train()
     for epoch in range(args.epochs):
-        for batch in source_train_loader:
+        for batch in DeviceLoader(source_train_loader, device):
             # optimizer.zero_grad()
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)  # [8, 128]
-            labels = batch['labels'].to(device)
+            input_ids = batch['input_ids']
+            attention_mask = batch['attention_mask']  # [8, 128]
+            labels = batch['labels']
             #outputs = model(input_ids, attention_mask=attention_mask, labels=labels)
             #loss = outputs.loss
             loss, logits, hidden_states, attentions = model(input_ids,attention_mask=attention_mask, labels=labels)
@@ -189,40 +193,10 @@ def train_single_source(source_domain_name, target_domain_name):
             progress_bar.update(1)
 
         # ----------validation----------
-        metric_val = load_metric("accuracy")
-        model.eval()
-
-        for batch in source_val_loader:
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)
-            labels = batch['labels'].to(device)
-            with torch.no_grad():
-                loss, logits, hidden_states, attentions = model(input_ids,attention_mask=attention_mask, labels=labels)
-                #outputs = model(input_ids, attention_mask=attention_mask, labels=labels)
-                #logits = outputs.logits
-
-            predictions = torch.argmax(logits, dim=-1)
-            metric_val.add_batch(predictions=predictions, references=batch["labels"])
-
-        s_score = metric_val.compute()
+        s_score = source_evaluator.evaluate(model, device)
 
         # ----------testing----------
-        metric_test = load_metric("accuracy")
-        model.eval()
-
-        for batch in target_test_loader:
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)
-            labels = batch['labels'].to(device)
-            with torch.no_grad():
-                loss, logits, hidden_states, attentions = model(input_ids,attention_mask=attention_mask, labels=labels)
-                #outputs = model(input_ids, attention_mask=attention_mask, labels=labels)
-                #logits = outputs.logits
-
-            predictions = torch.argmax(logits, dim=-1)
-            metric_test.add_batch(predictions=predictions, references=batch["labels"])
-
-        t_score = metric_test.compute()
+        t_score = target_evaluator.evaluate(model, device)
 
         print(source_domain_name, target_domain_name, s_score, t_score)
 
@@ -230,7 +204,7 @@ def train_single_source(source_domain_name, target_domain_name):
             s_acc = s_score['accuracy']
             t_acc = t_score['accuracy']
             checkpoint_path = args.ckpt_dir + "/" + source_domain_name + "-" + target_domain_name + ".linear.bert-baseline.analyze.ckpt"
-            torch.save(model.state_dict(), checkpoint_path)
+            save_model_state(model.state_dict(), checkpoint_path, args.ckpt_format)
 
     print (s_acc, t_acc)
     return t_acc
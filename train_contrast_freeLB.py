@@ -1,11 +1,19 @@
 import torch
 import argparse
 import os
+import random
+import time
 from pathlib import Path
 import numpy as np
-from data_process import process_small_data, myDataset, myDataset_unlabel
+from data_process import SmallDomainData, build_loader
+from loader import MultiDomainIterator, DeviceLoader, DomainLabels, parse_ratio, concat_batches
 from model import  Bertbaseline, BertAdvContrastSequenceClassification
-from loss import SymKlCriterion, JSCriterion, stable_kl, JSD
+from loss import SymKlCriterion, JSCriterion, stable_kl, JSD, InfoNCELoss, MomentumQueue
+from adversarial import PerturbationEngine
+from run_cache import RunRegistry, run_key, pair_data_keys
+from checkpoint import AsyncCheckpointer, CKPT_FORMATS, rng_states, set_rng_states
+from distributed import init_distributed, cleanup_distributed, get_rank, get_world_size, is_main_process, shared_seed, \
+    broadcast_parameters, all_reduce_gradients, all_gather_with_grad
 
 from torch.utils.data import DataLoader, SubsetRandomSampler
 from transformers import BertModel, AdamW, get_scheduler, AutoModelForSequenceClassification, AutoTokenizer
@@ -13,12 +21,16 @@ from transformers import BertModel, AdamW, get_scheduler, AutoModelForSequenceCl
 import torch.nn.functional as F
 
 from tqdm.auto import tqdm
-from datasets import load_metric
+from evaluate import Evaluator
+from profiler import StepProfiler, NO_PROFILER
 
 
 
 small_domain_names = ['book', 'electronics', 'beauty', 'music']
 
+# profiler phase prefix of domain label 0 and 1
+DOMAIN_NAMES = ('source', 'target')
+
 
 
 def sample_batch(dataset, args):
@@ -29,52 +41,225 @@ def sample_batch(dataset, args):
         break
     return batch
 
-def info_nce_loss(features, n_views, device, batch_size):
-    labels = torch.cat([torch.arange(batch_size) for i in range(n_views)], dim=0)
-    #labels = torch.cat([torch.arange(batch_size) for i in range(n_views)], dim=0)
-    labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float()
-    labels = labels.to(device)
-
-    features = F.normalize(features, dim=1)
-
-    similarity_matrix = torch.matmul(features, features.T)
-    # assert similarity_matrix.shape == (
-    #     self.args.n_views * self.args.batch_size, self.args.n_views * self.args.batch_size)
-    # assert similarity_matrix.shape == labels.shape
-
-    # discard the main diagonal from both: labels and similarities matrix
-    mask = torch.eye(labels.shape[0], dtype=torch.bool).to(device)
-    labels = labels[~mask].view(labels.shape[0], -1)
-    similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1)
-    # assert similarity_matrix.shape == labels.shape
-
-    # select and combine multiple positives
-    positives = similarity_matrix[labels.bool()].view(labels.shape[0], -1)
-
-    # select only the negatives the negatives
-    negatives = similarity_matrix[~labels.bool()].view(similarity_matrix.shape[0], -1)
-
-    logits = torch.cat([positives, negatives], dim=1)
-    labels = torch.zeros(logits.shape[0], dtype=torch.long).to(device)
-
-    logits = logits / args.tau
-
-    return logits, labels
+def perturb_embeddings(engine, model, optimizer, input_ids, attention_mask, domain_labels, slot='delta', rows=None):
+    """Gradient ascent of a word embedding perturbation on the domain classification loss.
+    Returns the clean embeddings and the final perturbation."""
+    def adv_domain_loss(inputs_embeds):
+        adv_class_loss, adv_class_logits, adv_domain_loss, adv_domain_logits, adv_hidden_states, adv_attentions, adv_z = model(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            class_labels=None,
+            domain_labels=domain_labels
+        )
+        return adv_domain_loss
+
+    embeds_init, delta, adv_loss = engine.perturb(
+        lambda: model.bert.embeddings.word_embeddings(input_ids), adv_domain_loss, attention_mask,
+        slot=slot, zero_grad=optimizer.zero_grad, rows=rows)
+    return embeds_init, delta
+
+def forward_views(model, views, fuse=False):
+    """Runs every (inputs_embeds, attention_mask) view through the model and returns
+    (class_logits, domain_logits, z, pooled) per view, pooled detached. With fuse the views are
+    right-padded to a common length and stacked into one batch, so there is a single large forward
+    instead of one per view."""
+    if not fuse:
+        outputs = []
+        for embeds, attention_mask in views:
+            class_loss, class_logits, domain_loss, domain_logits, hidden_states, attentions, z = model(
+                inputs_embeds=embeds, attention_mask=attention_mask)
+            outputs.append((class_logits, domain_logits, z, model.captured['pooled']))
+        return outputs
+
+    width = max(embeds.shape[1] for embeds, attention_mask in views)
+    embeds = torch.cat([F.pad(embeds, (0, 0, 0, width - embeds.shape[1])) for embeds, attention_mask in views], dim=0)
+    attention_mask = torch.cat([F.pad(attention_mask, (0, width - attention_mask.shape[1])) for embeds, attention_mask in views], dim=0)
+    class_loss, class_logits, domain_loss, domain_logits, hidden_states, attentions, z = model(
+        inputs_embeds=embeds, attention_mask=attention_mask)
+    sizes = [view[0].shape[0] for view in views]
+    return list(zip(class_logits.split(sizes), domain_logits.split(sizes), z.split(sizes), model.captured['pooled'].split(sizes)))
+
+def contrastive_loss(z, adv_z, contrast_lf, device, args, negatives=None):
+    # under torch.distributed the views of every process are gathered, the loss sees the global batch
+    z, adv_z = all_gather_with_grad(z), all_gather_with_grad(adv_z)
+    if args.contrast_update == 'one':
+        return contrast_lf(torch.cat([z, adv_z.detach()], dim=0), negatives)
+    elif args.contrast_update == 'mix':
+        contrast_loss_1 = contrast_lf(torch.cat([z, adv_z.detach()], dim=0), negatives)
+        contrast_loss_2 = contrast_lf(torch.cat([z.detach(), adv_z], dim=0), negatives)
+        return (contrast_loss_1 + contrast_loss_2) / 2
+    else:
+        return contrast_lf(torch.cat([z, adv_z], dim=0), negatives)
+
+def adversarial_view_loss(clean, adv, domain_labels, adv_lf, consist_lf, contrast_lf, device, args, queue=None, domain=0, profiler=NO_PROFILER):
+    """Adversarial, contrastive and consistency terms between one domain's clean and adversarial views.
+    With a queue the contrastive term also draws negatives from that domain's momentum queue, without
+    contrast_lf the contrastive term is left out. A profiler times the contrastive term as a phase."""
+    class_logits, domain_logits, z, pooled = clean
+    adv_class_logits, adv_domain_logits, adv_z, adv_pooled = adv
+
+    contrast_loss = 0
+    if contrast_lf is not None:
+        negatives = None
+        if queue is not None:
+            negatives = queue.negatives(domain)
+            queue.push(domain, pooled)
+        with profiler.phase(DOMAIN_NAMES[domain] + '/contrastive'):
+            contrast_loss = contrastive_loss(z, adv_z, contrast_lf, device, args, negatives)
+
+    if args.virtual_adv:
+        adv_loss = adv_lf(domain_logits, adv_domain_logits)
+    else:
+        adv_loss = F.cross_entropy(adv_domain_logits, domain_labels)
+    consistency_loss = consist_lf(class_logits, adv_class_logits)
+
+    return args.domain_lbd * args.adv_alpha * adv_loss + \
+           args.contrast_lbd * contrast_loss + \
+           args.consis_belta * consistency_loss
+
+def domain_loss(clean, adv, domain_labels, adv_lf, consist_lf, contrast_lf, device, args, queue=None, domain=0, profiler=NO_PROFILER):
+    """Domain, adversarial, contrastive and consistency terms of one domain's clean and adversarial views."""
+    return args.domain_lbd * F.cross_entropy(clean[1], domain_labels) + \
+           adversarial_view_loss(clean, adv, domain_labels, adv_lf, consist_lf, contrast_lf, device, args, queue, domain, profiler)
+
+def freelb_backward(engine, model, input_ids, attention_mask, groups, adv_lf, consist_lf, contrast_lf, device, args, rows=None, queue=None):
+    """FreeLB update of one batch: a single clean forward, then adv_steps adversarial forward/backward
+    passes whose parameter gradients accumulate (each scaled by 1/adv_steps) on top of the clean loss
+    gradients. As in FreeLB, delta ascends the whole adversarial-view loss (adversarial domain,
+    contrastive and consistency terms), not the domain loss alone.
+
+    groups holds (rows, domain, domain_labels, class_labels or None) for every domain stacked in the batch."""
+    sizes = [rows for rows, domain, domain_labels, class_labels in groups]
+    embeds = model.bert.embeddings.word_embeddings(input_ids)
+    clean = forward_views(model, [(embeds, attention_mask)])[0]
+    clean_parts = list(zip(*(out.split(sizes) for out in clean)))
+
+    clean_loss = 0
+    for part, (rows, domain, domain_labels, class_labels) in zip(clean_parts, groups):
+        clean_loss = clean_loss + args.domain_lbd * F.cross_entropy(part[1], domain_labels)
+        if class_labels is not None:
+            clean_loss = clean_loss + F.cross_entropy(part[0], class_labels)
+    # the clean graph is shared by every ascent step
+    clean_loss.backward(retain_graph=True)
+
+    def adv_loss(inputs_embeds):
+        adv = forward_views(model, [(inputs_embeds, attention_mask)])[0]
+        adv_parts = zip(*(out.split(sizes) for out in adv))
+        return sum(adversarial_view_loss(clean_part, adv_part, domain_labels, adv_lf, consist_lf, contrast_lf, device, args, queue, domain)
+                   for clean_part, adv_part, (rows, domain, domain_labels, class_labels) in zip(clean_parts, adv_parts, groups))
+
+    engine.perturb(lambda: embeds, adv_loss, attention_mask, backward=lambda loss: loss.backward(retain_graph=True), rows=rows)
+
+def rng_state(device):
+    return torch.get_rng_state(), torch.cuda.get_rng_state(device) if device.type == 'cuda' else None
+
+def grad_cache_backward(engine, model, optimizer, input_ids, attention_mask, domain, domain_labels, class_labels,
+                        adv_lf, consist_lf, contrast_lf, device, args, slot='delta', rows=None, queue=None):
+    """Gradient-cached update of one domain batch, for batches far larger than fit through BERT at once.
+    Every chunk of args.grad_cache_chunk rows gets its perturbation and a no-grad pass of both views, the
+    contrastive loss over the whole batch is backpropagated to the cached z only, and then each chunk is
+    run again with grad (replaying its dropout RNG) and backpropagates its own losses together with the
+    cached z gradients. Memory is bounded by the chunk while the InfoNCE denominator spans the batch."""
+    batch_size = input_ids.shape[0]
+    chunks = []
+    for start in range(0, batch_size, args.grad_cache_chunk):
+        part = slice(start, start + args.grad_cache_chunk)
+        part_rows = None if rows is None else rows[part]
+        embeds_init, delta = perturb_embeddings(engine, model, optimizer, input_ids[part], attention_mask[part], domain_labels[part], slot=slot, rows=part_rows)
+        # the engine hands back a reused buffer
+        delta = delta.clone()
+        state = rng_state(device)
+        with torch.no_grad():
+            clean, adv = forward_views(model, [(embeds_init, attention_mask[part]), (delta + embeds_init, attention_mask[part])], fuse=args.fuse_views)
+        chunks.append((part, delta, state, clean, adv))
+    optimizer.zero_grad()
+
+    # ===contrastive loss over the whole batch, backpropagated to the cached representations only===
+    z = torch.cat([clean[2] for part, delta, state, clean, adv in chunks], dim=0).requires_grad_()
+    adv_z = torch.cat([adv[2] for part, delta, state, clean, adv in chunks], dim=0).requires_grad_()
+    negatives = None
+    if queue is not None:
+        negatives = queue.negatives(domain)
+        queue.push(domain, torch.cat([clean[3] for part, delta, state, clean, adv in chunks], dim=0))
+    contrast_loss = args.contrast_lbd * contrastive_loss(z, adv_z, contrast_lf, device, args, negatives)
+    z_grad, adv_z_grad = torch.autograd.grad(contrast_loss, [z, adv_z])
+
+    # ===replay every chunk with grad===
+    devices = [device] if device.type == 'cuda' else []
+    for part, delta, (cpu_state, cuda_state), cached_clean, cached_adv in chunks:
+        with torch.random.fork_rng(devices=devices):
+            torch.set_rng_state(cpu_state)
+            if cuda_state is not None:
+                torch.cuda.set_rng_state(cuda_state, device)
+            embeds_init = model.bert.embeddings.word_embeddings(input_ids[part])
+            clean, adv = forward_views(model, [(embeds_init, attention_mask[part]), (delta + embeds_init, attention_mask[part])], fuse=args.fuse_views)
+        # the per-chunk losses are means, weight them by the chunk's share of the batch
+        loss = domain_loss(clean, adv, domain_labels[part], adv_lf, consist_lf, None, device, args)
+        if class_labels is not None:
+            loss = loss + F.cross_entropy(clean[0], class_labels[part])
+        loss = loss * clean[0].shape[0] / batch_size + \
+               (clean[2] * z_grad[part]).sum() + (adv[2] * adv_z_grad[part]).sum()
+        loss.backward()
+
+def training_state(model, optimizer, lr_scheduler, queue, checkpointer, epoch, step, acc, positions):
+    """Everything a run needs to go on from `step` of `epoch`, see restore_training_state. positions
+    are the StreamPositions of the domain streams after the last trained step."""
+    state = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'lr_scheduler': lr_scheduler.state_dict(),
+             'epoch': epoch, 'step': step, 'acc': acc, 'best': checkpointer.best, 'rng': rng_states(),
+             'data': [None if position is None else position.state_dict() for position in positions]}
+    if queue is not None:
+        state['queue'] = {'buffers': queue.state_dict(), 'ptr': queue.ptr, 'filled': queue.filled}
+    return state
+
+def restore_training_state(state, model, optimizer, lr_scheduler, queue, checkpointer):
+    """Loads a training_state, returns the (epoch, step) to go on from, the best accuracy so far, and
+    the positions of the domain streams (for MultiDomainIterator's resume)."""
+    model.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    lr_scheduler.load_state_dict(state['lr_scheduler'])
+    checkpointer.best = [tuple(entry) for entry in state['best']]
+    set_rng_states(state['rng'])
+    if queue is not None and 'queue' in state:
+        queue.load_state_dict(state['queue']['buffers'])
+        queue.ptr = list(state['queue']['ptr'])
+        queue.filled = list(state['queue']['filled'])
+    return state['epoch'], state['step'], state['acc'], state.get('data')
 
 def train_single_source(source_domain_name, target_domain_name, args):
-    s_labeled_encodings, s_labeled_labels, s_train_encodings, s_train_labels, s_val_encodings, s_val_labels, s_unlabeled_encodings = process_small_data(source_domain_name, max_length=args.max_length)
-    s_train_dataset = myDataset(s_train_encodings, s_train_labels)
-    s_val_dataset = myDataset(s_val_encodings, s_val_labels)
-    s_unlabeled_dataset = myDataset_unlabel(s_unlabeled_encodings)
-
-    t_labeled_encodings, t_labeled_labels, t_train_encodings, t_train_labels, t_val_encodings, t_val_labels, t_unlabeled_encodings = process_small_data(target_domain_name, max_length=args.max_length)
-    t_labeled_dataset = myDataset(t_labeled_encodings, t_labeled_labels)
-    t_unlabeled_dataset = myDataset_unlabel(t_unlabeled_encodings)
-
-    source_train_loader = DataLoader(s_train_dataset, batch_size=args.batch_size, shuffle=True)
-    source_val_loader = DataLoader(s_val_dataset, batch_size=args.batch_size)
-    target_unlabeled_loader = DataLoader(t_unlabeled_dataset, batch_size=args.batch_size, shuffle=True)
-    target_test_loader = DataLoader(t_labeled_dataset, batch_size=args.batch_size)
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+    source_data = SmallDomainData(source_domain_name, max_length=args.max_length, dynamic_padding=args.dynamic_padding, cache_dir=args.cache_dir)
+    s_train_dataset = source_data.dataset('train')
+    s_val_dataset = source_data.dataset('val')
+
+    target_data = SmallDomainData(target_domain_name, max_length=args.max_length, dynamic_padding=args.dynamic_padding, cache_dir=args.cache_dir)
+    t_labeled_dataset = target_data.dataset('labeled')
+
+    # an identical configuration that already finished is not trained again, a partial one resumes
+    run = None
+    if args.run_cache:
+        key = run_key(args, source_domain_name, target_domain_name, pair_data_keys(source_data, target_data))
+        run = RunRegistry(args.run_cache).open(key, source_domain_name, target_domain_name, args)
+        if run.finished:
+            if is_main_process():
+                print(source_domain_name, target_domain_name, 'cached run', key, run.record['acc'])
+            return run.record['acc']
+
+    # training batches are sharded over the processes, evaluation runs on the main process only
+    rank, world_size = get_rank(), get_world_size()
+    data_seed = shared_seed(args.seed)
+    pin_memory = torch.cuda.is_available()
+    source_train_loader = build_loader(s_train_dataset, args.batch_size, shuffle=True, dynamic_padding=args.dynamic_padding, num_workers=args.num_workers, pin_memory=pin_memory, rank=rank, world_size=world_size, seed=data_seed)
+    source_evaluator = Evaluator(s_val_dataset, args.eval_max_tokens, num_workers=args.num_workers, pin_memory=pin_memory, restore_mode=args.restore_train_mode)
+    if args.stream_unlabeled:
+        t_unlabeled_dataset = None
+        target_unlabeled_loader = DataLoader(target_data.unlabeled_stream(args.batch_size, rank=rank, world_size=world_size), batch_size=None, num_workers=args.num_workers, pin_memory=pin_memory)
+    else:
+        t_unlabeled_dataset = target_data.dataset('unlabeled')
+        target_unlabeled_loader = build_loader(t_unlabeled_dataset, args.batch_size, shuffle=True, dynamic_padding=args.dynamic_padding, num_workers=args.num_workers, pin_memory=pin_memory, rank=rank, world_size=world_size, seed=data_seed)
+    target_evaluator = Evaluator(t_labeled_dataset, args.eval_max_tokens, num_workers=args.num_workers, pin_memory=pin_memory, restore_mode=args.restore_train_mode)
 
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
@@ -92,364 +277,226 @@ def train_single_source(source_domain_name, target_domain_name, args):
     )
 
     model.to(device)
-    progress_bar = tqdm(range(num_training_steps))
     adv_lf = SymKlCriterion()
     consist_lf = JSD()
-    contrast_lf = torch.nn.CrossEntropyLoss()
-    cosine_metric = torch.nn.CosineSimilarity(dim=-1)
-    acc = 0
+    contrast_lf = InfoNCELoss(args.tau, args.contrast_chunk_size or None)
+    # one negative queue per domain, fed by a momentum copy of the projection head
+    queue = MomentumQueue(model.contrast_MLP, size=args.contrast_queue_size, momentum=args.contrast_momentum) if args.contrast_queue_size > 0 else None
+
+    # the full training state goes to the run's directory (or next to the checkpoints) and is written
+    # in the background like the best --keep_best checkpoints, a partial run goes on from its last state
+    checkpoint_prefix = args.ckpt_dir + "/" + source_domain_name + "-" + target_domain_name + ".tau_0.5.linear.contrast.analyze"
+    checkpointer = AsyncCheckpointer(run.path if run is not None else checkpoint_prefix + ".state", keep_best=args.keep_best, ckpt_format=args.ckpt_format)
+    start_epoch, start_step, acc, data_positions = 0, 0, 0, None
+    state = checkpointer.load_state() if run is not None or args.resume else None
+    if state is not None:
+        start_epoch, start_step, acc, data_positions = restore_training_state(state, model, optimizer, lr_scheduler, queue, checkpointer)
+    # the banks hold perturbations by row of exactly these splits, a resumed run goes on from its own
+    bank_meta = None
+    if args.adv_bank_dir:
+        source_rows = len(s_train_dataset)
+        bank_meta = {'pair': [source_domain_name, target_domain_name], 'data': pair_data_keys(source_data, target_data),
+                     'rows': {'source': [0, source_rows],
+                              'target': None if t_unlabeled_dataset is None else [source_rows, source_rows + len(t_unlabeled_dataset)]},
+                     'hidden_size': model.bert.config.hidden_size}
+    engine = PerturbationEngine.from_args(args, 'pgd', bank_meta=bank_meta, bank_reuse=state is not None)
+    freelb_engine = PerturbationEngine.from_args(args, 'freelb', bank_meta=bank_meta, bank_reuse=state is not None)
+    del state
+    best_checkpoint = checkpointer.best_path()
+    broadcast_parameters(model)
+    progress_bar = tqdm(range(num_training_steps), disable=not is_main_process())
+    progress_bar.update(start_epoch * len(source_train_loader) + start_step)
     # ====================training=====================
     model.train()
-    for epoch in range(args.epochs):
-        for s_l_batch, t_ul_batch in zip(source_train_loader, target_unlabeled_loader):
-            optimizer.zero_grad()
-
-            s_l_input_ids = s_l_batch['input_ids'].to(device)
-            s_l_attention_mask = s_l_batch['attention_mask'].to(device)  # [8, 128]
-            s_l_labels = s_l_batch['labels'].to(device)
-            s_l_domain_labels = torch.zeros(s_l_input_ids.shape[0]).long().to(device)
-
-            t_ul_input_ids = t_ul_batch['input_ids'].to(device)
-            t_ul_attention_mask = t_ul_batch['attention_mask'].to(device)
-            t_ul_domain_labels = torch.ones(t_ul_input_ids.shape[0]).long().to(device)
-
-            # ==========source labeled data==========
-
-            # ===adversarial===
-            # adversarial on the domain classification
-            inputs = {"attention_mask": s_l_attention_mask, "labels": s_l_domain_labels}
-
-            embeds_init = model.bert.embeddings.word_embeddings(s_l_input_ids)
-
-            if args.adv_init_mag > 0:
-                input_mask = inputs['attention_mask'].to(embeds_init)
-                input_lengths = torch.sum(input_mask, 1)
-
-                if args.norm_type == "l2":
-                    delta = torch.zeros_like(embeds_init).uniform_(-1, 1) * input_mask.unsqueeze(2)
-                    dims = input_lengths * embeds_init.size(-1)
-                    mag = args.adv_init_mag / torch.sqrt(dims)
-                    delta = (delta * mag.view(-1, 1, 1)).detach()
-                elif args.norm_type == "linf":
-                    delta = torch.zeros_like(embeds_init).uniform_(-args.adv_init_mag, args.adv_init_mag) * input_mask.unsqueeze(2)
-
-            elif args.adv_noise_var > 0:
-                input_mask = inputs['attention_mask'].to(embeds_init)
-                delta = torch.zeros_like(embeds_init).normal_(0, 1) * args.adv_noise_var
-                delta = delta * input_mask.unsqueeze(2)
-
-            else:
-                delta = torch.zeros_like(embeds_init)
-
-            for step in range(args.adv_steps):
-                delta.requires_grad_()
-                inputs['inputs_embeds'] = delta + embeds_init
-                adv_s_l_class_loss, adv_s_l_class_logits, adv_s_l_domain_loss, adv_s_l_domain_logits, adv_s_l_hidden_states, adv_s_l_attentions, adv_s_l_z = model(
-                    inputs_embeds=inputs['inputs_embeds'],
-                    attention_mask=inputs["attention_mask"],
-                    class_labels=None,
-                    domain_labels=inputs["labels"]
-                )
-
-                # (1) calc the adversarial loss - KL divergence
-                # adv_logits = adv_logits.view(-1, 1)
-                #adv_s_l_loss = stable_kl(adv_s_l_domain_logits, s_l_domain_logits.detach(), reduce=False)
-
-                # (2) calc the gradient for the noise
-                #delta_grad, = torch.autograd.grad(adv_s_l_domain_loss, delta, only_inputs=True, retain_graph=False)
-                #s_l_norm = s_l_delta_grad.norm()
-                #if (torch.isnan(s_l_norm) or torch.isinf(s_l_norm)):
-                #    return 0
-                adv_s_l_domain_loss.backward()
-                delta_grad = delta.grad.clone().detach()
-
-                # (3) update the perturbation
-                #s_l_eff_delta_grad = s_l_delta_grad * args.adv_lr
-                #s_l_delta_grad = s_l_noise + s_l_delta_grad * args.adv_lr
-                #s_l_noise, s_l_eff_noise = norm_grad(s_l_delta_grad, eff_grad=s_l_eff_delta_grad, sentence_level=False)
-                #s_l_noise = s_l_noise.detach()
-                #s_l_noise.requires_grad_()
-                if args.norm_type == "l2":
-                    denorm = torch.norm(delta_grad.view(delta_grad.size(0), -1), dim=1).view(-1, 1, 1)
-                    denorm = torch.clamp(denorm, min=1e-8)
-                    delta = (delta + args.adv_lr * delta_grad / denorm).detach()
-                    if args.adv_max_norm > 0:
-                        delta_norm = torch.norm(delta.view(delta.size(0), -1).float(), p=2, dim=1).detach()
-                        exceed_mask = (delta_norm > args.adv_max_norm).to(embeds_init)
-                        reweights = (args.adv_max_norm / delta_norm * exceed_mask + (1 - exceed_mask)).view(-1, 1, 1)
-                        delta = (delta * reweights).detach()
-                elif args.norm_type == "linf":
-                    denorm = torch.norm(delta_grad.view(delta_grad.size(0), -1), dim=1, p=float("inf")).view(-1, 1, 1)
-                    denorm = torch.clamp(denorm, min=1e-8)
-                    delta = (delta + args.adv_lr * delta_grad / denorm).detach()
-                    if args.adv_max_norm > 0:
-                        delta = torch.clamp(delta, -args.adv_max_norm, args.adv_max_norm).detach()
-                else:
-                    print("Norm type {} not specified.".format(args.norm_type))
-                    exit()
-
-                embeds_init = model.bert.embeddings.word_embeddings(s_l_input_ids)
-                delta.requires_grad_()
-                optimizer.zero_grad()
-
-            # (4) calc the virtual adversarial training loss
-            s_l_class_loss, s_l_class_logits, s_l_domain_loss, s_l_domain_logits, s_l_hidden_states, s_l_attentions, s_l_z = model(
-                input_ids=s_l_input_ids,
-                attention_mask=s_l_attention_mask,
-                class_labels=s_l_labels,
-                domain_labels=s_l_domain_labels
-            )
-
-            inputs['inputs_embeds'] = delta + embeds_init
-            adv_s_l_class_loss, adv_s_l_class_logits, adv_s_l_domain_loss, adv_s_l_domain_logits, adv_s_l_hidden_states, adv_s_l_attentions, adv_s_l_z = model(
-                inputs_embeds=inputs['inputs_embeds'],
-                attention_mask=s_l_attention_mask,
-                class_labels=s_l_labels,
-                domain_labels=s_l_domain_labels
-            )
-            if args.virtual_adv:
-                adv_s_l_loss = adv_lf(s_l_domain_logits, adv_s_l_domain_logits)
-            else:
-                adv_s_l_loss = adv_s_l_domain_loss
-
-            # ===contrastive===
-            if args.contrast_update == 'one':
-                z_cat = torch.cat([s_l_z, adv_s_l_z.detach()], dim=0)
-                s_l_contrast_logits, s_l_contrast_labels = info_nce_loss(z_cat,n_views=2, device=device,batch_size=s_l_z.shape[0])
-                s_l_contrast_loss = contrast_lf(s_l_contrast_logits, s_l_contrast_labels)
-            elif args.contrast_update == 'mix':
-                z_cat_1 = torch.cat([s_l_z, adv_s_l_z.detach()], dim=0)
-                s_l_contrast_logits_1, s_l_contrast_labels_1 = info_nce_loss(z_cat_1, n_views=2, device=device,batch_size=s_l_z.shape[0])
-                s_l_contrast_loss_1 = contrast_lf(s_l_contrast_logits_1, s_l_contrast_labels_1)
-                z_cat_2 = torch.cat([s_l_z.detach(), adv_s_l_z], dim=0)
-                s_l_contrast_logits_2, s_l_contrast_labels_2 = info_nce_loss(z_cat_2, n_views=2, device=device,batch_size=s_l_z.shape[0])
-                s_l_contrast_loss_2 = contrast_lf(s_l_contrast_logits_2, s_l_contrast_labels_2)
-                s_l_contrast_loss = (s_l_contrast_loss_1 + s_l_contrast_loss_2) / 2
-            else:
-                s_l_contrast_logits, s_l_contrast_labels = info_nce_loss(torch.cat([s_l_z, adv_s_l_z], dim=0), n_views=2, device=device, batch_size=s_l_z.shape[0])
-                s_l_contrast_loss = contrast_lf(s_l_contrast_logits, s_l_contrast_labels)
-            '''
-            pos = (cosine_metric(s_l_z, adv_s_l_z) / args.tau).mean()
-            neg_matrix = cosine_metric(adv_s_l_z.unsqueeze(0), adv_s_l_z.unsqueeze(1)) / args.tau
-            neg_matrix = torch.exp(neg_matrix) * (1 - torch.eye(adv_s_l_z.shape[0], dtype=torch.float).to(device))
-            neg = neg_matrix.sum(dim=-1)
-            neg = torch.log(neg).mean()
-            s_l_contrast_loss = neg - pos
-            '''
-            # ===consistency loss===
-            s_l_consistency_loss=consist_lf(s_l_class_logits, adv_s_l_class_logits)
-
-            # ===loss===
-            loss = s_l_class_loss + \
-                   args.domain_lbd*(s_l_domain_loss+args.adv_alpha*adv_s_l_loss) +\
-                   args.contrast_lbd*s_l_contrast_loss +\
-                   args.consis_belta*s_l_consistency_loss
-            loss.backward()
-            optimizer.step()
+    domain_iter = MultiDomainIterator([source_train_loader, target_unlabeled_loader], ratio=parse_ratio(args.domain_ratio),
+                                      resume=data_positions)
+    device_iter = iter(DeviceLoader(domain_iter, device))
+    domain_label_cache = DomainLabels(device)
+    # opt-in per-phase timings of the training step, off it costs nothing
+    profiler = StepProfiler(device, enabled=args.profile, sync_every=args.profile_sync_every, trace_steps=args.profile_trace_steps or None)
+    for epoch in range(start_epoch, args.epochs):
+        epoch_start = time.time()
+        # a resumed epoch only runs its remaining steps
+        for i in range(start_step if epoch == start_epoch else 0, len(source_train_loader)):
+            with profiler.phase('data'):
+                s_l_batch, t_ul_batch = next(device_iter)
             optimizer.zero_grad()
 
-
-            # ==========target unlabel data==========
-            # ===adversarial===
-            # adversarial on the domain classification
-            inputs = {"attention_mask": t_ul_attention_mask, "labels": t_ul_domain_labels}
-
-            embeds_init = model.bert.embeddings.word_embeddings(t_ul_input_ids)
-
-            if args.adv_init_mag > 0:
-                input_mask = inputs['attention_mask'].to(embeds_init)
-                input_lengths = torch.sum(input_mask, 1)
-
-                if args.norm_type == "l2":
-                    delta = torch.zeros_like(embeds_init).uniform_(-1, 1) * input_mask.unsqueeze(2)
-                    dims = input_lengths * embeds_init.size(-1)
-                    mag = args.adv_init_mag / torch.sqrt(dims)
-                    delta = (delta * mag.view(-1, 1, 1)).detach()
-                elif args.norm_type == "linf":
-                    delta = torch.zeros_like(embeds_init).uniform_(-args.adv_init_mag,args.adv_init_mag) * input_mask.unsqueeze(2)
-
-            elif args.adv_noise_var > 0:
-                input_mask = inputs['attention_mask'].to(embeds_init)
-                delta = torch.zeros_like(embeds_init).normal_(0, 1) * args.adv_noise_var
-                delta = delta * input_mask.unsqueeze(2)
-
+            s_l_input_ids = s_l_batch['input_ids']
+            s_l_attention_mask = s_l_batch['attention_mask']  # [8, 128]
+            s_l_labels = s_l_batch['labels']
+            s_l_domain_labels = domain_label_cache(s_l_input_ids.shape[0], 0)
+
+            t_ul_input_ids = t_ul_batch['input_ids']
+            t_ul_attention_mask = t_ul_batch['attention_mask']
+            t_ul_domain_labels = domain_label_cache(t_ul_input_ids.shape[0], 1)
+
+            # bank rows: target rows follow the source rows, a streamed target set has no row index
+            s_l_rows = s_l_batch['idx']
+            positions = (s_l_batch['position'], t_ul_batch['position'])
+            t_ul_rows = t_ul_batch['idx'] + len(s_train_dataset) if 'idx' in t_ul_batch else None
+
+            if args.fuse_domains:
+                joint = concat_batches([
+                    {'input_ids': s_l_input_ids, 'attention_mask': s_l_attention_mask},
+                    {'input_ids': t_ul_input_ids, 'attention_mask': t_ul_attention_mask}
+                ])
+                n_source = s_l_input_ids.shape[0]
+                joint_rows = None if t_ul_rows is None else torch.cat([s_l_rows, t_ul_rows], dim=0)
+
+            if args.grad_cache_chunk:
+                # ==========gradient-cached source labeled data==========
+                with profiler.phase('source/grad_cache'):
+                    grad_cache_backward(engine, model, optimizer, s_l_input_ids, s_l_attention_mask, 0, s_l_domain_labels, s_l_labels,
+                                        adv_lf, consist_lf, contrast_lf, device, args, slot='source', rows=s_l_rows, queue=queue)
+                with profiler.phase('source/step'):
+                    all_reduce_gradients(model)
+                    optimizer.step()
+                    optimizer.zero_grad()
+
+                # ==========gradient-cached target unlabel data==========
+                with profiler.phase('target/grad_cache'):
+                    grad_cache_backward(engine, model, optimizer, t_ul_input_ids, t_ul_attention_mask, 1, t_ul_domain_labels, None,
+                                        adv_lf, consist_lf, contrast_lf, device, args, slot='target', rows=t_ul_rows, queue=queue)
+            elif args.freelb and args.fuse_domains:
+                # ==========FreeLB on source labeled and target unlabel data in one step==========
+                with profiler.phase('joint/freelb'):
+                    freelb_backward(freelb_engine, model, joint['input_ids'], joint['attention_mask'],
+                                    [(n_source, 0, s_l_domain_labels, s_l_labels), (t_ul_input_ids.shape[0], 1, t_ul_domain_labels, None)],
+                                    adv_lf, consist_lf, contrast_lf, device, args, rows=joint_rows, queue=queue)
+            elif args.freelb:
+                # ==========FreeLB on source labeled data==========
+                with profiler.phase('source/freelb'):
+                    freelb_backward(freelb_engine, model, s_l_input_ids, s_l_attention_mask,
+                                    [(s_l_input_ids.shape[0], 0, s_l_domain_labels, s_l_labels)],
+                                    adv_lf, consist_lf, contrast_lf, device, args, rows=s_l_rows, queue=queue)
+                with profiler.phase('source/step'):
+                    all_reduce_gradients(model)
+                    optimizer.step()
+                    optimizer.zero_grad()
+
+                # ==========FreeLB on target unlabel data==========
+                with profiler.phase('target/freelb'):
+                    freelb_backward(freelb_engine, model, t_ul_input_ids, t_ul_attention_mask,
+                                    [(t_ul_input_ids.shape[0], 1, t_ul_domain_labels, None)],
+                                    adv_lf, consist_lf, contrast_lf, device, args, rows=t_ul_rows, queue=queue)
+            elif args.fuse_domains:
+                # ==========source labeled and target unlabel data in one step==========
+                # the perturbation is normalized per example, so ascending it on the joint batch
+                # gives every row the same update as ascending it per domain
+                joint_domain_labels = torch.cat([s_l_domain_labels, t_ul_domain_labels], dim=0)
+                with profiler.phase('joint/ascent'):
+                    embeds_init, delta = perturb_embeddings(engine, model, optimizer, joint['input_ids'], joint['attention_mask'], joint_domain_labels, rows=joint_rows)
+                with profiler.phase('joint/forward'):
+                    clean, adv = forward_views(model, [(embeds_init, joint['attention_mask']), (delta + embeds_init, joint['attention_mask'])], fuse=args.fuse_views)
+
+                s_l_clean, t_ul_clean = zip(*(out.split([n_source, out.shape[0] - n_source]) for out in clean))
+                s_l_adv, t_ul_adv = zip(*(out.split([n_source, out.shape[0] - n_source]) for out in adv))
+
+                with profiler.phase('joint/loss'):
+                    loss = F.cross_entropy(s_l_clean[0], s_l_labels) + \
+                           domain_loss(s_l_clean, s_l_adv, s_l_domain_labels, adv_lf, consist_lf, contrast_lf, device, args, queue, 0, profiler) + \
+                           domain_loss(t_ul_clean, t_ul_adv, t_ul_domain_labels, adv_lf, consist_lf, contrast_lf, device, args, queue, 1, profiler)
+                with profiler.phase('joint/backward'):
+                    loss.backward()
             else:
-                delta = torch.zeros_like(embeds_init)
-
-            for step in range(args.adv_steps):
-                delta.requires_grad_()
-                inputs['inputs_embeds'] = delta + embeds_init
-                adv_t_ul_class_loss, adv_t_ul_class_logits, adv_t_ul_domain_loss, adv_t_ul_domain_logits, adv_t_ul_hidden_states, adv_t_ul_attentions, adv_t_ul_z = model(
-                    inputs_embeds=inputs['inputs_embeds'],
-                    attention_mask=inputs["attention_mask"],
-                    class_labels=None,
-                    domain_labels=inputs["labels"]
-                )
-
-                # (1) calc the adversarial loss - KL divergence
-                # adv_logits = adv_logits.view(-1, 1)
-                # adv_s_l_loss = stable_kl(adv_s_l_domain_logits, s_l_domain_logits.detach(), reduce=False)
-
-                # (2) calc the gradient for the noise
-                # delta_grad, = torch.autograd.grad(adv_s_l_domain_loss, delta, only_inputs=True, retain_graph=False)
-                # s_l_norm = s_l_delta_grad.norm()
-                # if (torch.isnan(s_l_norm) or torch.isinf(s_l_norm)):
-                #    return 0
-                adv_t_ul_domain_loss.backward()
-                delta_grad = delta.grad.clone().detach()
-
-                # (3) update the perturbation
-                # s_l_eff_delta_grad = s_l_delta_grad * args.adv_lr
-                # s_l_delta_grad = s_l_noise + s_l_delta_grad * args.adv_lr
-                # s_l_noise, s_l_eff_noise = norm_grad(s_l_delta_grad, eff_grad=s_l_eff_delta_grad, sentence_level=False)
-                # s_l_noise = s_l_noise.detach()
-                # s_l_noise.requires_grad_()
-                if args.norm_type == "l2":
-                    denorm = torch.norm(delta_grad.view(delta_grad.size(0), -1), dim=1).view(-1, 1, 1)
-                    denorm = torch.clamp(denorm, min=1e-8)
-                    delta = (delta + args.adv_lr * delta_grad / denorm).detach()
-                    if args.adv_max_norm > 0:
-                        delta_norm = torch.norm(delta.view(delta.size(0), -1).float(), p=2, dim=1).detach()
-                        exceed_mask = (delta_norm > args.adv_max_norm).to(embeds_init)
-                        reweights = (args.adv_max_norm / delta_norm * exceed_mask + (1 - exceed_mask)).view(-1, 1, 1)
-                        delta = (delta * reweights).detach()
-                elif args.norm_type == "linf":
-                    denorm = torch.norm(delta_grad.view(delta_grad.size(0), -1), dim=1, p=float("inf")).view(-1, 1, 1)
-                    denorm = torch.clamp(denorm, min=1e-8)
-                    delta = (delta + args.adv_lr * delta_grad / denorm).detach()
-                    if args.adv_max_norm > 0:
-                        delta = torch.clamp(delta, -args.adv_max_norm, args.adv_max_norm).detach()
-                else:
-                    print("Norm type {} not specified.".format(args.norm_type))
-                    exit()
-
-                embeds_init = model.bert.embeddings.word_embeddings(t_ul_input_ids)
-                delta.requires_grad_()
-                optimizer.zero_grad()
-
-            # (4) calc the virtual adversarial training loss
-            t_ul_class_loss, t_ul_class_logits, t_ul_domain_loss, t_ul_domain_logits, t_ul_hidden_states, t_ul_attentions, t_ul_z = model(
-                input_ids=t_ul_input_ids,
-                attention_mask=t_ul_attention_mask,
-                class_labels=None,
-                domain_labels=t_ul_domain_labels
-            )
-
-            inputs['inputs_embeds'] = delta + embeds_init
-            adv_t_ul_class_loss, adv_t_ul_class_logits, adv_t_ul_domain_loss, adv_t_ul_domain_logits, adv_t_ul_hidden_states, adv_t_ul_attentions, adv_t_ul_z = model(
-                inputs_embeds=inputs['inputs_embeds'],
-                attention_mask=t_ul_attention_mask,
-                class_labels=None,
-                domain_labels=t_ul_domain_labels
-            )
-            if args.virtual_adv:
-                adv_t_ul_loss = adv_lf(t_ul_domain_logits, adv_t_ul_domain_logits)
-            else:
-                adv_t_ul_loss = adv_t_ul_domain_loss
-
-            # ===contrastive===
-            if args.contrast_update == 'one':
-                z_cat = torch.cat([t_ul_z, adv_t_ul_z.detach()], dim=0)
-                t_ul_contrast_logits, t_ul_contrast_labels = info_nce_loss(z_cat, n_views=2, device=device,batch_size=t_ul_z.shape[0])
-                t_ul_contrast_loss = contrast_lf(t_ul_contrast_logits, t_ul_contrast_labels)
-            elif args.contrast_update == 'mix':
-                z_cat_1 = torch.cat([t_ul_z, adv_t_ul_z.detach()], dim=0)
-                t_ul_contrast_logits_1, t_ul_contrast_labels_1 = info_nce_loss(z_cat_1, n_views=2, device=device,batch_size=t_ul_z.shape[0])
-                t_ul_contrast_loss_1 = contrast_lf(t_ul_contrast_logits_1, t_ul_contrast_labels_1)
-                z_cat_2 = torch.cat([t_ul_z.detach(), adv_t_ul_z], dim=0)
-                t_ul_contrast_logits_2, t_ul_contrast_labels_2 = info_nce_loss(z_cat_2, n_views=2, device=device,batch_size=t_ul_z.shape[0])
-                t_ul_contrast_loss_2 = contrast_lf(t_ul_contrast_logits_2, t_ul_contrast_labels_2)
-                t_ul_contrast_loss = (t_ul_contrast_loss_1 + t_ul_contrast_loss_2) / 2
-            else:
-                t_ul_contrast_logits, t_ul_contrast_labels = info_nce_loss(torch.cat([t_ul_z, adv_t_ul_z], dim=0), n_views=2, device=device,batch_size=t_ul_z.shape[0])
-                t_ul_contrast_loss = contrast_lf(t_ul_contrast_logits, t_ul_contrast_labels)
-
-            # ===consistency loss===
-            t_ul_consistency_loss = consist_lf(t_ul_class_logits, adv_t_ul_class_logits)
-
-            # ===loss===
-            loss = args.domain_lbd * (t_ul_domain_loss + args.adv_alpha * adv_t_ul_loss) + \
-                   args.contrast_lbd * t_ul_contrast_loss + \
-                   args.consis_belta * t_ul_consistency_loss
-            loss.backward()
+                # ==========source labeled data==========
+                with profiler.phase('source/ascent'):
+                    embeds_init, delta = perturb_embeddings(engine, model, optimizer, s_l_input_ids, s_l_attention_mask, s_l_domain_labels, slot='source', rows=s_l_rows)
+                with profiler.phase('source/forward'):
+                    s_l_clean, s_l_adv = forward_views(model, [(embeds_init, s_l_attention_mask), (delta + embeds_init, s_l_attention_mask)], fuse=args.fuse_views)
+
+                with profiler.phase('source/loss'):
+                    loss = F.cross_entropy(s_l_clean[0], s_l_labels) + \
+                           domain_loss(s_l_clean, s_l_adv, s_l_domain_labels, adv_lf, consist_lf, contrast_lf, device, args, queue, 0, profiler)
+                with profiler.phase('source/backward'):
+                    loss.backward()
+                with profiler.phase('source/step'):
+                    all_reduce_gradients(model)
+                    optimizer.step()
+                    optimizer.zero_grad()
+
+                # ==========target unlabel data==========
+                with profiler.phase('target/ascent'):
+                    embeds_init, delta = perturb_embeddings(engine, model, optimizer, t_ul_input_ids, t_ul_attention_mask, t_ul_domain_labels, slot='target', rows=t_ul_rows)
+                with profiler.phase('target/forward'):
+                    t_ul_clean, t_ul_adv = forward_views(model, [(embeds_init, t_ul_attention_mask), (delta + embeds_init, t_ul_attention_mask)], fuse=args.fuse_views)
+
+                with profiler.phase('target/loss'):
+                    loss = domain_loss(t_ul_clean, t_ul_adv, t_ul_domain_labels, adv_lf, consist_lf, contrast_lf, device, args, queue, 1, profiler)
+                with profiler.phase('target/backward'):
+                    loss.backward()
 
             # ==========optimizer step==========
-            optimizer.step()
-            lr_scheduler.step()
-            optimizer.zero_grad()
+            with profiler.phase('optimizer'):
+                all_reduce_gradients(model)
+                optimizer.step()
+                lr_scheduler.step()
+                optimizer.zero_grad()
+                if queue is not None:
+                    queue.step(model.contrast_MLP)
+            profiler.step()
             progress_bar.update(1)
+            if args.save_every and (i + 1) % args.save_every == 0 and i + 1 < len(source_train_loader):
+                engine.save_bank()
+                freelb_engine.save_bank()
+                if is_main_process():
+                    checkpointer.save_state(training_state(model, optimizer, lr_scheduler, queue, checkpointer, epoch, i + 1, acc, positions))
+
+        # every process keeps its own bank, a resumed (or --adv_bank_reuse) run warm-starts from it
+        engine.save_bank()
+        freelb_engine.save_bank()
 
         # ====================evaluation====================
-        metric_val = load_metric("accuracy")
-        metric_val_domain = load_metric("accuracy")
-        model.eval()
-
-        for batch in source_val_loader:
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)
-            class_labels = batch['labels'].to(device)
-            domain_labels = torch.zeros(input_ids.shape[0]).long().to(device)
-            with torch.no_grad():
-                class_loss, class_logits, domain_loss, domain_logits, hidden_states, attentions, z = model(
-                    input_ids=input_ids,
-                    attention_mask=attention_mask,
-                    class_labels=class_labels,
-                    domain_labels=domain_labels
-                )
-
-            predictions = torch.argmax(class_logits, dim=-1)
-            metric_val.add_batch(predictions=predictions, references=batch["labels"])
-            domain_predictions = torch.argmax(domain_logits, dim=-1)
-            metric_val_domain.add_batch(predictions=domain_predictions, references=torch.zeros(input_ids.shape[0]).long())
-
-        s_score = metric_val.compute()
-        s_domain_score = metric_val_domain.compute()
+        if not is_main_process():
+            continue
+        s_score, s_domain_score = source_evaluator.evaluate(model, device, domain=0)
 
         # ----------testing----------
-        metric_test = load_metric("accuracy")
-        metric_test_domain = load_metric("accuracy")
-        model.eval()
-
-        for batch in target_test_loader:
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)
-            class_labels = batch['labels'].to(device)
-            domain_labels = torch.ones(input_ids.shape[0]).long().to(device)
-            with torch.no_grad():
-                class_loss, class_logits, domain_loss, domain_logits, hidden_states, attentions, z = model(
-                    input_ids=input_ids,
-                    attention_mask=attention_mask,
-                    class_labels=class_labels,
-                    domain_labels=domain_labels,
-                )
-
-            predictions = torch.argmax(class_logits, dim=-1)
-            metric_test.add_batch(predictions=predictions, references=batch["labels"])
-            domain_predictions = torch.argmax(domain_logits, dim=-1)
-            metric_test_domain.add_batch(predictions=domain_predictions,
-                                        references=torch.ones(input_ids.shape[0]).long())
-
-
-        t_score = metric_test.compute()
-        t_domain_score = metric_test_domain.compute()
+        t_score, t_domain_score = target_evaluator.evaluate(model, device, domain=1)
 
         print(source_domain_name, target_domain_name, s_score, s_domain_score, t_score, t_domain_score)
-
-        if t_score['accuracy'] >= acc:
-            acc = t_score['accuracy']
-            checkpoint_path = args.ckpt_dir + "/" + source_domain_name + "-" + target_domain_name + ".tau_0.5.linear.contrast.analyze.ckpt"
-            torch.save(model.state_dict(), checkpoint_path)
-
-    print (acc)
+        print((freelb_engine if args.freelb else engine).summary())
+        if args.profile:
+            print(profiler.summary())
+            profiler.reset()
+        engine.reset_timings()
+        freelb_engine.reset_timings()
+
+        # the one best checkpoint keeps the fixed <pair>...analyze.ckpt name, several are told apart by epoch
+        best_name = checkpoint_prefix + (".ckpt" if args.keep_best == 1 else ".epoch{}.ckpt".format(epoch))
+        if checkpointer.save_best(model.state_dict(), t_score['accuracy'], best_name):
+            best_checkpoint = checkpointer.best_path()
+        acc = max(acc, t_score['accuracy'])
+        if epoch + 1 < args.epochs:
+            checkpointer.save_state(training_state(model, optimizer, lr_scheduler, queue, checkpointer, epoch + 1, 0, acc, positions))
+
+        if run is not None:
+            run.log_epoch(epoch, {'source_acc': s_score['accuracy'], 'target_acc': t_score['accuracy']}, time.time() - epoch_start,
+                          best_checkpoint, acc)
+
+    domain_iter.close()
+    checkpointer.close()
+    if args.profile and args.profile_trace and is_main_process():
+        profiler.export_chrome_trace(args.profile_trace)
+    if is_main_process():
+        print (acc)
+        print('best checkpoint', best_checkpoint)
+        if run is not None:
+            run.finish(acc)
+        # the training state is only needed by partial runs
+        checkpointer.clear_state()
 
     return acc
 
-if __name__ == "__main__":
+def get_parser():
     parser = argparse.ArgumentParser(description='PyTorch BERT Text Classification')
     parser.add_argument('--output_dir', type=str, default='./results',
                         help='location of the output dir')
     parser.add_argument('--ckpt_dir', type=str, default='./checkpoints',
                         help='location of the checkpoint dir')
+    parser.add_argument('--ckpt_format', type=str, default='full', choices=CKPT_FORMATS,
+                        help='format of the saved model checkpoints: full (fp32 torch.save), or the opt-in compact fp16 or delta (int8 delta against the pretrained BERT), see checkpoint.py')
     parser.add_argument('--task_type', type=str, default='in_domain',
                         help='task type, in_domain, single_source, multi_source, DA')
     parser.add_argument('--dataset', type=str, default='amazon',
@@ -478,6 +525,22 @@ if __name__ == "__main__":
                         help='if load from a pretrained domain classifier')
     parser.add_argument('--max_length', type=int, default=512,
                         help='max length')
+    parser.add_argument('--dynamic_padding', action='store_true',
+                        help='pad each batch to its longest sequence and batch examples of similar length together')
+    parser.add_argument('--cache_dir', type=str, default='data/cache',
+                        help='location of the memory-mapped tokenization cache, empty to tokenize on every run')
+    parser.add_argument('--eval_max_tokens', type=int, default=16384,
+                        help='padded tokens per evaluation batch, examples are batched longest first under this budget')
+    parser.add_argument('--restore_train_mode', action='store_true',
+                        help='put the model back into train mode (dropout on) after every evaluation, by default it stays in eval mode as it always did')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='number of data loader worker processes')
+    parser.add_argument('--stream_unlabeled', action='store_true',
+                        help='read and tokenize the target unlabeled file as a stream instead of loading it')
+    parser.add_argument('--dist_backend', type=str, default='gloo',
+                        help='torch.distributed backend when launched with torchrun (gloo runs on CPU)')
+    parser.add_argument('--domain_ratio', type=str, default='1:1',
+                        help='source:target number of loader batches drawn per step')
     parser.add_argument('--wd', type=float, default=1e-2,
                         help='weight decay')
 
@@ -493,15 +556,40 @@ if __name__ == "__main__":
                         help="Maximum norm of adversarial perturbation, set to 0 to be unlimited, 0, 7e-1")
     parser.add_argument('--norm_type', type=str, default='linf',
                         help='linf or l2 or l1')
+    parser.add_argument('--adv_grad_mode', type=str, default='delta', choices=['full', 'delta'],
+                        help='full: ascent steps backpropagate into all parameters, delta: only into the perturbation')
+    parser.add_argument('--adv_bank_dir', type=str, default='',
+                        help='directory of the memory-mapped per-example perturbation bank used to warm-start the adversary, empty to disable')
+    parser.add_argument('--adv_bank_tokens', type=int, default=16,
+                        help='number of largest-norm tokens of every perturbation kept in the bank')
+    parser.add_argument('--adv_bank_slots', type=int, default=65536,
+                        help='number of examples the bank holds before evicting the least recently updated ones')
+    parser.add_argument('--adv_bank_reuse', action='store_true',
+                        help='warm-start from the bank a previous run of the same pair and data left in --adv_bank_dir, a resumed run always does')
     parser.add_argument('--adv_alpha', type=float, default=1,
                         help='virtual adversarial loss alpha')
     parser.add_argument('--virtual_adv', action='store_true',
                         help='if using virtual adversarial training to substitute the standard adversarial training')
+    parser.add_argument('--fuse_views', action='store_true',
+                        help='run the clean and adversarial views through BERT as one concatenated batch')
+    parser.add_argument('--freelb', action='store_true',
+                        help='FreeLB training: one clean forward and adv_steps adversarial passes whose gradients accumulate into the update')
+    parser.add_argument('--fuse_domains', action='store_true',
+                        help='train on the source and target batches in one joint step (one optimizer step per iteration instead of two)')
 
     parser.add_argument('--contrast_lbd', type=float, default=0.05,
                         help='contrastive labmda')
     parser.add_argument('--tau', type=float, default=0.12,
                         help='contrastive temperature')
+    parser.add_argument('--contrast_chunk_size', type=int, default=0,
+                        help='rows of the similarity matrix per checkpointed chunk in the contrastive loss, 0 for no chunking')
+    parser.add_argument('--contrast_queue_size', type=int, default=0,
+                        help='negatives kept per domain in a momentum-encoder queue for the contrastive loss, 0 for in-batch negatives only')
+    parser.add_argument('--contrast_momentum', type=float, default=0.999,
+                        help='momentum of the key projection head that feeds the contrastive queue')
+    parser.add_argument('--grad_cache_chunk', type=int, default=0,
+                        help='gradient caching: rows per BERT pass, so --batch_size can be far larger than fits in memory '
+                             'while the contrastive loss still spans the whole batch (0 disables; takes precedence over --freelb/--fuse_domains)')
     parser.add_argument('--contrast_update', type=str, default='two',
                         help='one, mix, two')
 
@@ -511,9 +599,36 @@ if __name__ == "__main__":
     parser.add_argument('--consis_belta', type=float, default=3,
                         help='belta for consistency loss')
 
-    args = parser.parse_args()
+    parser.add_argument('--profile', action='store_true',
+                        help='time the phases of every training step (ascent, forwards, losses, backward, steps) and print a table per epoch')
+    parser.add_argument('--profile_sync_every', type=int, default=50,
+                        help='steps between the points where the profiler waits for the device to resolve its timings')
+    parser.add_argument('--profile_trace', type=str, default='',
+                        help='with --profile, write the phases as a Chrome trace (json) to this file at the end of training')
+    parser.add_argument('--profile_trace_steps', type=int, default=200,
+                        help='number of first steps kept in the Chrome trace, 0 for all')
+    parser.add_argument('--run_cache', type=str, default='',
+                        help='run registry directory: finished configurations are skipped and partial ones resume, empty to disable')
+    parser.add_argument('--save_every', type=int, default=0,
+                        help='also save the full training state every N steps, 0 for only at the end of every epoch')
+    parser.add_argument('--keep_best', type=int, default=1,
+                        help='number of best target accuracy checkpoints kept: 1 keeps <source>-<target>.tau_0.5.linear.contrast.analyze.ckpt, '
+                             'more keep ...analyze.epoch<N>.ckpt files, the best of them is printed at the end')
+    parser.add_argument('--resume', action='store_true',
+                        help='go on from the saved training state of the pair if there is one (always on with --run_cache)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed of torch, numpy and random for this run, unseeded by default')
+    return parser
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
 
-    torch.cuda.set_device(args.gpu)
+    rank, world_size, device = init_distributed(args.dist_backend)
+    if world_size == 1 and torch.cuda.is_available():
+        torch.cuda.set_device(args.gpu)
+    if world_size > 1 and args.adv_bank_dir:
+        # every process keeps the perturbations of its own shard
+        args.adv_bank_dir = os.path.join(args.adv_bank_dir, 'rank{}'.format(rank))
 
 
     #train_single_source('electronics', 'book', args)
@@ -530,4 +645,5 @@ if __name__ == "__main__":
                 print (acc_array, np.average(acc_array), np.std(acc_array))
     '''
     train_single_source('electronics', 'book', args)
-    #train_single_source('music', 'beauty', args)
\ No newline at end of file
+    #train_single_source('music', 'beauty', args)
+    cleanup_distributed()
\ No newline at end of file
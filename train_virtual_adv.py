@@ -3,8 +3,10 @@ import argparse
 import os
 from pathlib import Path
 import numpy as np
-from data_process import process_small_data, myDataset
+from data_process import process_small_data, myDataset, build_loader
+from loader import DeviceLoader
 from model import Bertbaseline, BertContrastSequenceClassification
+from adversarial import PerturbationEngine
 from torch.utils.data import DataLoader, SubsetRandomSampler
 from transformers import BertModel, AdamW, get_scheduler, AutoModelForSequenceClassification, AutoTokenizer
 
@@ -12,7 +14,7 @@ import torch.nn.functional as F
 from torch.nn.modules.loss import _Loss
 
 from tqdm.auto import tqdm
-from datasets import load_metric
+from metrics import StreamingMetrics
 
 parser = argparse.ArgumentParser(description='PyTorch BERT Text Classification')
 parser.add_argument('--output_dir', type=str, default='./results',
@@ -55,6 +57,8 @@ parser.add_argument('--load_from_pretrain', action='store_true',
                     help='if load from a pretrained domain classifier')
 parser.add_argument('--max_length', type=int, default=512,
                     help='max length')
+parser.add_argument('--num_workers', type=int, default=0,
+                    help='number of data loader worker processes')
 
 parser.add_argument('--adv_steps', type=int, default=1,
                     help="Number of gradient ascent steps for the adversary, should be at least 1")
@@ -167,7 +171,7 @@ def train_in_domain(domain_name):
 
     model = Bertbaseline(num_labels=3)
 
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
+    train_loader = build_loader(train_dataset, args.batch_size, shuffle=True, num_workers=args.num_workers, pin_memory=torch.cuda.is_available())
     test_loader = DataLoader(val_dataset, batch_size=args.batch_size)
 
     # ---optimizer---
@@ -183,15 +187,16 @@ def train_in_domain(domain_name):
 
     model.to(device)
     progress_bar = tqdm(range(num_training_steps))
+    engine = PerturbationEngine.from_args(args, 'vat')
     acc = 0
     # ---training---
     model.train()
     for epoch in range(args.epochs):
-        for batch in train_loader:
+        for batch in DeviceLoader(train_loader, device):
             # optimizer.zero_grad()
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)  # [8, 512]
-            labels = batch['labels'].to(device)
+            input_ids = batch['input_ids']
+            attention_mask = batch['attention_mask']  # [8, 512]
+            labels = batch['labels']
             # outputs = model(input_ids, attention_mask=attention_mask, labels=labels)
 
 
@@ -201,47 +206,21 @@ def train_in_domain(domain_name):
 
             inputs = {"attention_mask": attention_mask, "labels": labels}
 
-            embeds_init = model.bert.embeddings.word_embeddings(input_ids)
-
-            noise = torch.zeros_like(embeds_init).normal_(0, 1) * args.adv_noise_var
-            noise.detach()
-            noise.requires_grad_()
-
-            for step in range(args.adv_steps):
-                inputs['inputs_embeds'] = noise + embeds_init
+            # (1) calc the adversarial loss - KL divergence
+            def adv_kl(inputs_embeds):
                 adv_loss, adv_logits, hidden_states, attentions = model(
-                    inputs_embeds=inputs['inputs_embeds'],
+                    inputs_embeds=inputs_embeds,
                     attention_mask=inputs['attention_mask'],
                     labels=inputs['labels']
                 )
+                return stable_kl(adv_logits, logits.detach(), reduce=False)
+
+            # (2) ascend the noise along the gradient of the divergence
+            embeds_init, noise, adv_loss = engine.perturb(
+                lambda: model.bert.embeddings.word_embeddings(input_ids), adv_kl, attention_mask)
+            if not torch.isfinite(noise).all():
+                return 0
 
-                # (1) calc the adversarial loss - KL divergence
-                #adv_logits = adv_logits.view(-1, 1)
-                adv_loss = stable_kl(adv_logits, logits.detach(), reduce=False)
-
-                # (2) calc the gradient for the noise
-                delta_grad, = torch.autograd.grad(adv_loss, noise, only_inputs=True, retain_graph=False)
-
-                norm = delta_grad.norm()
-                if (torch.isnan(norm) or torch.isinf(norm)):
-                    return 0
-
-                delta_grad_clone = delta_grad.clone().detach()
-                denorm = torch.norm(delta_grad_clone.view(delta_grad_clone.size(0), -1), dim=1, p=float("inf")).view(-1, 1, 1)
-                denorm = torch.clamp(denorm, min=1e-8)
-                noise = (noise + args.adv_lr * delta_grad_clone / denorm).detach()
-                if args.adv_max_norm > 0:
-                    noise = torch.clamp(noise, -args.adv_max_norm, args.adv_max_norm).detach()
-
-                noise.requires_grad_()
-
-                '''
-                eff_delta_grad = delta_grad * args.adv_lr
-                delta_grad = noise + delta_grad * args.adv_lr
-                noise, eff_noise = norm_grad(delta_grad, eff_grad=eff_delta_grad, sentence_level=False)
-                noise = noise.detach()
-                noise.requires_grad_()
-                '''
             inputs['inputs_embeds'] = noise + embeds_init
             adv_loss, adv_logits, hidden_states, attentions = model(
                 inputs_embeds=inputs['inputs_embeds'],
@@ -392,7 +371,7 @@ def train_in_domain(domain_name):
             progress_bar.update(1)
             '''
         # ---evaluation---
-        metric = load_metric("accuracy")
+        metric = StreamingMetrics(model.num_labels, device)
         model.eval()
         for batch in test_loader:
             input_ids = batch['input_ids'].to(device)
@@ -427,7 +406,7 @@ def train_single_source(source_domain_name, target_domain_name):
         target_domain_name, max_length=args.max_length)
     t_labeled_dataset = myDataset(t_labeled_encodings, t_labeled_labels)
 
-    source_train_loader = DataLoader(s_train_dataset, batch_size=args.batch_size, shuffle=True)
+    source_train_loader = build_loader(s_train_dataset, args.batch_size, shuffle=True, num_workers=args.num_workers, pin_memory=torch.cuda.is_available())
     source_val_loader = DataLoader(s_val_dataset, batch_size=args.batch_size)
     target_test_loader = DataLoader(t_labeled_dataset, batch_size=args.batch_size)
 
@@ -451,84 +430,34 @@ def train_single_source(source_domain_name, target_domain_name):
 
     model.to(device)
     progress_bar = tqdm(range(num_training_steps))
+    engine = PerturbationEngine.from_args(args, 'freelb', adv_noise_var=0)
     s_acc = 0
     t_acc = 0
-    tr_loss, logging_loss = 0.0, 0.0
     # ---training---
     model.train()
     for epoch in range(args.epochs):
-        for batch in source_train_loader:
+        for batch in DeviceLoader(source_train_loader, device):
             # optimizer.zero_grad()
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)  # [8, 128]
-            labels = batch['labels'].to(device)
+            input_ids = batch['input_ids']
+            attention_mask = batch['attention_mask']  # [8, 128]
+            labels = batch['labels']
             # outputs = model(input_ids, attention_mask=attention_mask, labels=labels)
             # loss = outputs.loss
 
             # =========adversarial training========
             inputs = {"attention_mask": attention_mask, "labels": labels}
 
-            embeds_init = model.bert.embeddings.word_embeddings(input_ids)
-
-            if args.adv_init_mag > 0:
-                input_mask = inputs['attention_mask'].to(embeds_init)
-                input_lengths = torch.sum(input_mask, 1)
-
-                if args.norm_type == "l2":
-                    delta = torch.zeros_like(embeds_init).uniform_(-1, 1) * input_mask.unsqueeze(2)
-                    dims = input_lengths * embeds_init.size(-1)
-                    mag = args.adv_init_mag / torch.sqrt(dims)
-                    delta = (delta * mag.view(-1, 1, 1)).detach()
-                elif args.norm_type == "linf":
-                    delta = torch.zeros_like(embeds_init).uniform_(-args.adv_init_mag,
-                                                                   args.adv_init_mag) * input_mask.unsqueeze(2)
-            else:
-                delta = torch.zeros_like(embeds_init)
-
-            # the main loop
-            for astep in range(args.adv_steps):
-                # (0) forward
-                delta.requires_grad_()
-                inputs['inputs_embeds'] = delta + embeds_init
+            def adv_loss_fn(inputs_embeds):
                 loss, logits, hidden_states, attentions = model(
-                    inputs_embeds=inputs['inputs_embeds'],
+                    inputs_embeds=inputs_embeds,
                     attention_mask=inputs['attention_mask'],
                     labels=inputs['labels']
                 )
+                return loss
 
-                # (1) backward
-                loss = loss / args.adv_steps
-                tr_loss += loss.item()
-
-                loss.backward()
-
-                if astep == args.adv_steps - 1:
-                    break
-
-                # (2) get gradient on delta
-                delta_grad = delta.grad.clone().detach()
-
-                # (3) update and clip
-                if args.norm_type == "l2":
-                    denorm = torch.norm(delta_grad.view(delta_grad.size(0), -1), dim=1).view(-1, 1, 1)
-                    denorm = torch.clamp(denorm, min=1e-8)
-                    delta = (delta + args.adv_lr * delta_grad / denorm).detach()
-                    if args.adv_max_norm > 0:
-                        delta_norm = torch.norm(delta.view(delta.size(0), -1).float(), p=2, dim=1).detach()
-                        exceed_mask = (delta_norm > args.adv_max_norm).to(embeds_init)
-                        reweights = (args.adv_max_norm / delta_norm * exceed_mask + (1 - exceed_mask)).view(-1, 1, 1)
-                        delta = (delta * reweights).detach()
-                elif args.norm_type == "linf":
-                    denorm = torch.norm(delta_grad.view(delta_grad.size(0), -1), dim=1, p=float("inf")).view(-1, 1, 1)
-                    denorm = torch.clamp(denorm, min=1e-8)
-                    delta = (delta + args.adv_lr * delta_grad / denorm).detach()
-                    if args.adv_max_norm > 0:
-                        delta = torch.clamp(delta, -args.adv_max_norm, args.adv_max_norm).detach()
-                else:
-                    print("Norm type {} not specified.".format(args.norm_type))
-                    exit()
-
-                embeds_init = model.bert.embeddings.word_embeddings(input_ids)
+            # the main loop
+            embeds_init, delta, loss = engine.perturb(
+                lambda: model.bert.embeddings.word_embeddings(input_ids), adv_loss_fn, attention_mask)
 
             # loss, logits, hidden_states, attentions = model(input_ids,attention_mask=attention_mask, labels=labels)
 
@@ -540,7 +469,7 @@ def train_single_source(source_domain_name, target_domain_name):
             progress_bar.update(1)
 
         # ----------validation----------
-        metric_val = load_metric("accuracy")
+        metric_val = StreamingMetrics(model.num_labels, device)
         model.eval()
 
         for batch in source_val_loader:
@@ -558,7 +487,7 @@ def train_single_source(source_domain_name, target_domain_name):
         s_score = metric_val.compute()
 
         # ----------testing----------
-        metric_test = load_metric("accuracy")
+        metric_test = StreamingMetrics(model.num_labels, device)
         model.eval()
 
         for batch in target_test_loader: